@@ -0,0 +1,46 @@
+import multiprocessing
+
+import numpy
+
+
+logger = multiprocessing.get_logger()
+
+
+class BufferPool(object):
+    ### Output arrays reused from frame to frame
+    # The pool is rebuilt when the frame size or data type changes (binning, RAW8/RAW16).
+    # Buffers are overwritten by the next frame, anything kept longer must be copied.
+
+    def __init__(self):
+        self._buffers = dict()  # name => array
+        self._frame_key = None
+
+
+    def reset(self, frame_shape, frame_dtype):
+        frame_key = (tuple(frame_shape), numpy.dtype(frame_dtype))
+
+        if frame_key == self._frame_key:
+            return
+
+        if self._frame_key:
+            logger.warning('Frame changed from %s to %s, rebuilding buffer pool', self._frame_key, frame_key)
+
+        self._buffers.clear()
+        self._frame_key = frame_key
+
+
+    def get(self, name, shape, dtype):
+        shape = tuple(shape)
+        dtype = numpy.dtype(dtype)
+
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = numpy.empty(shape, dtype=dtype)
+            self._buffers[name] = buf
+
+        return buf
+
+
+    @property
+    def nbytes(self):
+        return sum([b.nbytes for b in self._buffers.values()])
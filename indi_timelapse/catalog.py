@@ -0,0 +1,224 @@
+import os
+import time
+import sqlite3
+import threading
+from pathlib import Path
+from datetime import datetime
+
+import multiprocessing
+
+
+logger = multiprocessing.get_logger()
+
+
+CATALOG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS image (
+    id          INTEGER PRIMARY KEY,
+    filename    TEXT NOT NULL UNIQUE,
+    createDate  REAL NOT NULL,
+    dayDate     TEXT NOT NULL,
+    night       INTEGER NOT NULL,
+    type        TEXT NOT NULL,
+    exposure    REAL,
+    gain        INTEGER,
+    binmode     INTEGER,
+    adu         REAL,
+    size        INTEGER,
+    width       INTEGER,
+    height      INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS image_day_idx ON image (dayDate, night, type, createDate);
+CREATE INDEX IF NOT EXISTS image_createDate_idx ON image (createDate);
+'''
+
+
+class ImageCatalog(object):
+    ### Index of the image files, updated when files are written
+    # Filenames are stored relative to the base folder
+    # The connection is opened in the process that uses the catalog
+
+    def __init__(self, db_file, base_dir):
+        self.db_file = Path(db_file)
+        self.base_dir = Path(base_dir)
+
+        self._conn = None
+        self._lock = threading.Lock()  # fits are written from a thread pool
+
+
+    def _connect(self):
+        if self._conn:
+            return self._conn
+
+        self._conn = sqlite3.connect(str(self.db_file), timeout=10.0, check_same_thread=False)
+
+        # readers do not block the writer
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+
+        self._conn.executescript(CATALOG_SCHEMA)
+
+        return self._conn
+
+
+    def close(self):
+        with self._lock:
+            if not self._conn:
+                return
+
+            self._conn.close()
+            self._conn = None
+
+
+    def addImage(self, filename, exp_date, day_date, night, image_type='image', exposure=None, gain=None, binmode=None, adu=None, size=None, width=None, height=None):
+        row = (
+            self._relative(filename),
+            exp_date.timestamp(),
+            day_date,
+            int(night),
+            image_type,
+            exposure,
+            gain,
+            binmode,
+            adu,
+            size,
+            width,
+            height,
+        )
+
+        try:
+            with self._lock:
+                conn = self._connect()
+                with conn:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO image (filename, createDate, dayDate, night, type, exposure, gain, binmode, adu, size, width, height) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        row,
+                    )
+        except sqlite3.Error as e:
+            # catalog problems must not stop image processing
+            logger.error('Unable to add %s to catalog: %s', filename, str(e))
+
+
+    def getImages(self, day_date=None, night=None, before=None, image_type='image'):
+        ### Returns absolute paths ordered by exposure time
+        where = ['type = ?']
+        params = [image_type]
+
+        if day_date is not None:
+            where.append('dayDate = ?')
+            params.append(day_date)
+
+        if night is not None:
+            where.append('night = ?')
+            params.append(int(night))
+
+        if before is not None:
+            where.append('createDate < ?')
+            params.append(before.timestamp())
+
+        query = 'SELECT filename FROM image WHERE {0:s} ORDER BY createDate, filename'.format(' AND '.join(where))
+
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute(query, params).fetchall()
+
+        return [self.base_dir.joinpath(r[0]) for r in rows]
+
+
+    def removeImages(self, file_list):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany('DELETE FROM image WHERE filename = ?', [(self._relative(f),) for f in file_list])
+
+
+    def check(self, img_folder, extension_list, fix=False):
+        ### Compare the catalog with the files on disk
+        # Returns lists of catalog entries without files and files missing from the catalog
+        start = time.time()
+
+        disk_files = dict()
+        self._scanFolder(Path(img_folder), extension_list, disk_files, top=True)
+
+        with self._lock:
+            conn = self._connect()
+            catalog_files = set(r[0] for r in conn.execute('SELECT filename FROM image WHERE type = ?', ('image',)))
+
+        missing_list = sorted(catalog_files.difference(disk_files.keys()))
+        untracked_list = sorted(set(disk_files.keys()).difference(catalog_files))
+
+        logger.warning('Catalog: %d entries, %d files on disk', len(catalog_files), len(disk_files))
+        logger.warning('Catalog: %d entries without files, %d files not in catalog', len(missing_list), len(untracked_list))
+
+
+        if fix:
+            rows = list()
+            for f in untracked_list:
+                row = self._fileRow(f, disk_files[f])
+                if row:
+                    rows.append(row)
+
+            with self._lock:
+                conn = self._connect()
+                with conn:
+                    conn.executemany('DELETE FROM image WHERE filename = ?', [(f,) for f in missing_list])
+                    conn.executemany(
+                        'INSERT OR REPLACE INTO image (filename, createDate, dayDate, night, type, size) VALUES (?, ?, ?, ?, ?, ?)',
+                        rows,
+                    )
+
+            logger.warning('Catalog: removed %d entries, added %d files', len(missing_list), len(rows))
+
+
+        elapsed_s = time.time() - start
+        logger.info('Catalog checked in %0.4f s', elapsed_s)
+
+        return missing_list, untracked_list
+
+
+    def _scanFolder(self, folder, extension_list, disk_files, top=False):
+        dot_extension_list = ['.{0:s}'.format(e) for e in extension_list]
+
+        with os.scandir(str(folder)) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+
+                if entry.is_dir(follow_symlinks=False):
+                    self._scanFolder(entry.path, extension_list, disk_files)  # recursion
+                elif top:
+                    # latest image is not a timelapse image
+                    continue
+                elif entry.is_file(follow_symlinks=False) and os.path.splitext(entry.name)[1] in dot_extension_list:
+                    size = entry.stat().st_size
+                    if size == 0:
+                        # incomplete files are not used
+                        continue
+
+                    disk_files[self._relative(entry.path)] = size
+
+
+    def _fileRow(self, filename, size):
+        # images/<day>/<night|day>/<hour>/<YYYYmmdd_HHMMSS>.<ext>
+        f_path = Path(filename)
+
+        try:
+            exp_date = datetime.strptime(f_path.stem[:15], '%Y%m%d_%H%M%S')
+        except ValueError:
+            logger.warning('Unable to parse date from filename: %s', filename)
+            return None
+
+        parts = f_path.parts
+        if len(parts) < 4 or parts[-3] not in ('day', 'night'):
+            logger.warning('Unexpected folder layout: %s', filename)
+            return None
+
+        return (filename, exp_date.timestamp(), parts[-4], int(parts[-3] == 'night'), 'image', size)
+
+
+    def _relative(self, filename):
+        try:
+            return str(Path(filename).relative_to(self.base_dir))
+        except ValueError:
+            return str(filename)
+
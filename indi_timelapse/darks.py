@@ -0,0 +1,102 @@
+import io
+from pathlib import Path
+from collections import OrderedDict
+
+import multiprocessing
+
+from astropy.io import fits
+
+from . import fastfits
+
+
+logger = multiprocessing.get_logger()
+
+
+class DarkLibrary(object):
+    def __init__(self, dark_folder, max_bytes=536870912):
+        self.dark_folder = Path(dark_folder)
+        self.max_bytes = int(max_bytes)
+
+        self._cache = OrderedDict()  # (exposure, gain, bin) => (mtime, data)
+        self._cache_bytes = 0
+
+
+    @property
+    def cache_bytes(self):
+        return self._cache_bytes
+
+
+    def getDarkFile(self, exposure, gain, binning):
+        return self.dark_folder.joinpath('dark_{0:d}s_gain{1:d}_bin{2:d}.fit'.format(int(exposure), int(gain), int(binning)))
+
+
+    def get(self, exposure, gain, binning):
+        key = (int(exposure), int(gain), int(binning))
+        dark_file = self.getDarkFile(*key)
+
+        try:
+            dark_mtime = dark_file.stat().st_mtime
+        except FileNotFoundError:
+            # remove stale entry if the dark has been deleted
+            self._evict(key)
+            return None
+
+
+        entry = self._cache.get(key)
+        if entry:
+            mtime, data = entry
+
+            if mtime == dark_mtime:
+                self._cache.move_to_end(key)  # most recently used
+                return data
+
+            logger.warning('Dark modified, reloading: %s', dark_file)
+            self._evict(key)
+
+
+        data = self._load(dark_file)
+
+        if data.nbytes > self.max_bytes:
+            logger.warning('Dark exceeds library size limit, not cached: %s', dark_file)
+            return data
+
+
+        # evict least recently used darks until the new dark fits
+        while self._cache and (self._cache_bytes + data.nbytes) > self.max_bytes:
+            old_key = next(iter(self._cache))
+            logger.info('Evicting dark from library: %s', self.getDarkFile(*old_key))
+            self._evict(old_key)
+
+        self._cache[key] = (dark_mtime, data)
+        self._cache_bytes += data.nbytes
+
+        logger.info('Dark library: %d darks, %0.1f MB', len(self._cache), self._cache_bytes / 1048576)
+
+        return data
+
+
+    def clear(self):
+        self._cache.clear()
+        self._cache_bytes = 0
+
+
+    def _evict(self, key):
+        entry = self._cache.pop(key, None)
+        if entry:
+            self._cache_bytes -= entry[1].nbytes
+
+
+    def _load(self, dark_file):
+        logger.info('Loading dark: %s', dark_file)
+
+        with io.open(str(dark_file), 'rb') as f_dark:
+            data = fastfits.decode(bytearray(f_dark.read()))
+
+        if data is not None:
+            return data
+
+        with fits.open(str(dark_file)) as dark:
+            data = dark[0].data.copy()  # detach from the file
+            del dark[0].data   # make sure memory is freed
+
+        return data
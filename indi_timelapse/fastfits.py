@@ -0,0 +1,113 @@
+import multiprocessing
+
+import numpy
+
+
+logger = multiprocessing.get_logger()
+
+
+FITS_BLOCK_SIZE = 2880
+FITS_CARD_SIZE = 80
+
+HEADER_KEYS = (b'SIMPLE', b'BITPIX', b'NAXIS', b'NAXIS1', b'NAXIS2', b'BZERO', b'BSCALE')
+
+
+def parse_header(buf):
+    ### Only the cards needed to locate and interpret the primary data array
+    header = dict()
+
+    buf_len = len(buf)
+    offset = 0
+
+    while offset + FITS_BLOCK_SIZE <= buf_len:
+        block = bytes(buf[offset:offset + FITS_BLOCK_SIZE])
+        offset += FITS_BLOCK_SIZE
+
+        for i in range(0, FITS_BLOCK_SIZE, FITS_CARD_SIZE):
+            card = block[i:i + FITS_CARD_SIZE]
+            key = card[:8].rstrip()
+
+            if key == b'END':
+                return header, offset
+
+            if key not in HEADER_KEYS or card[8:10] != b'= ':
+                continue
+
+            value = card[10:].split(b'/', 1)[0].strip()
+
+            try:
+                if value in (b'T', b'F'):
+                    header[key.decode()] = value == b'T'
+                elif b'.' in value or b'E' in value:
+                    header[key.decode()] = float(value)
+                else:
+                    header[key.decode()] = int(value)
+            except ValueError:
+                return None, 0
+
+
+    # END card not found
+    return None, 0
+
+
+def decode(buf):
+    ### Returns a 2D array over the blob buffer or None if astropy is needed to decode the data
+    # 16 bit data is byte swapped in place when the buffer is writable
+
+    header, data_offset = parse_header(buf)
+
+    if not header:
+        logger.warning('Unable to parse FITS header')
+        return None
+
+    if not header.get('SIMPLE') or header.get('NAXIS') != 2:
+        return None
+
+    if header.get('BSCALE', 1) != 1:
+        return None
+
+
+    bitpix = header.get('BITPIX')
+    bzero = header.get('BZERO', 0)
+
+    if bitpix == 8 and bzero == 0:
+        dtype = numpy.dtype(numpy.uint8)
+    elif bitpix == 16 and bzero == 0:
+        dtype = numpy.dtype('>i2')
+    elif bitpix == 16 and bzero == 32768:
+        dtype = numpy.dtype('>u2')
+    else:
+        return None
+
+
+    width = header['NAXIS1']
+    height = header['NAXIS2']
+    count = width * height
+
+    if data_offset + (count * dtype.itemsize) > len(buf):
+        logger.warning('FITS data truncated')
+        return None
+
+
+    data = numpy.frombuffer(buf, dtype=dtype, count=count, offset=data_offset)
+
+    if not dtype.isnative:
+        if data.flags.writeable:
+            data.byteswap(inplace=True)
+            data = data.view(dtype.newbyteorder())
+        else:
+            data = data.astype(dtype.newbyteorder())
+
+    if bzero == 32768:
+        # signed + 32768 is the same as flipping the sign bit
+        if not data.flags.writeable:
+            data = data.copy()
+
+        data ^= 0x8000
+
+    if not data.flags.writeable:
+        # bytes from the queue, the image is modified in place later
+        data = data.copy()
+
+
+    return data.reshape((height, width))
@@ -31,14 +31,21 @@ class ftps(GenericFileTransfer):
             raise ConnectionFailure(str(e)) from e
         except ConnectionRefusedError as e:
             raise ConnectionFailure(str(e)) from e
+        except (ftplib.error_temp, ftplib.error_reply, EOFError, OSError) as e:
+            raise ConnectionFailure(str(e)) from e
 
-        client.auth()
-        client.prot_p()  # setup encypted channel
+        try:
+            client.auth()
+            client.prot_p()  # setup encypted channel
+        except ftplib.all_errors as e:
+            raise ConnectionFailure(str(e)) from e
 
         try:
             client.login(user=username, passwd=password)
         except ftplib.error_perm as e:
             raise AuthenticationFailure(str(e)) from e
+        except (ftplib.error_temp, ftplib.error_reply, EOFError, OSError) as e:
+            raise ConnectionFailure(str(e)) from e
 
         client.set_pasv(True)
 
@@ -47,17 +54,59 @@ class ftps(GenericFileTransfer):
 
     def _close(self):
         if self.client:
-            self.client.quit()
+            try:
+                self.client.quit()
+            except ftplib.all_errors:
+                self.client.close()
+
+
+    def _is_connected(self):
+        return self.client.sock is not None
+
+
+    def _keepalive(self):
+        try:
+            self.client.voidcmd('NOOP')
+        except ftplib.all_errors as e:
+            raise ConnectionFailure(str(e)) from e
 
 
-    def _put(self, localfile, remotefile):
-        with io.open(str(localfile), 'rb') as f_localfile:
+    def _put(self, localfile, remotefile, offset=0):
+        try:
+            f_localfile = io.open(str(localfile), 'rb')
+        except OSError as e:
+            raise TransferFailure(str(e)) from e
+
+        with f_localfile:
+            if offset:
+                f_localfile.seek(offset)
 
             try:
-                self.client.storbinary('STOR {0}'.format(str(remotefile)), f_localfile, blocksize=262144)
+                self.client.storbinary(
+                    'STOR {0}'.format(str(remotefile)),
+                    f_localfile,
+                    blocksize=self.block_size,
+                    callback=lambda block: self._throttle(len(block)),
+                    rest=offset if offset else None,
+                )
             except ftplib.error_perm as e:
                 f_localfile.close()
                 raise TransferFailure(str(e)) from e
+            except (ftplib.error_temp, ftplib.error_reply, EOFError, OSError) as e:
+                # session is broken
+                f_localfile.close()
+                raise ConnectionFailure(str(e)) from e
 
             f_localfile.close()
 
+
+    def _size(self, remotefile):
+        try:
+            self.client.voidcmd('TYPE I')  # SIZE is not reliable in ascii mode
+            return self.client.size(str(remotefile))
+        except ftplib.error_perm:
+            # file not found
+            return None
+        except (ftplib.error_temp, ftplib.error_reply, EOFError, OSError) as e:
+            raise ConnectionFailure(str(e)) from e
+
@@ -1,5 +1,9 @@
+import time
+
 import multiprocessing
 
+from .exceptions import ConnectionFailure
+
 logger = multiprocessing.get_logger()
 
 
@@ -10,6 +14,12 @@ class GenericFileTransfer(object):
         self.port = 0
         self.client = None
 
+        self.block_size = 262144
+        self.rate_limit = 0  # bytes per second, 0 is unlimited
+
+        self._throttle_start = 0.0
+        self._throttle_bytes = 0
+
 
     def __del__(self):
         pass
@@ -25,10 +35,64 @@ class GenericFileTransfer(object):
 
 
     def close(self):
-        self._close()
+        try:
+            self._close()
+        except Exception as e:
+            # connection may already be broken
+            logger.warning('Error closing connection: %s', str(e))
+
+        self.client = None
+
+
+    def is_connected(self):
+        # local check, no round trip
+        if not self.client:
+            return False
+
+        return self._is_connected()
+
+
+    def keepalive(self):
+        # round trip to keep the session open, returns False if the session is broken
+        if not self.client:
+            return False
+
+        try:
+            self._keepalive()
+        except ConnectionFailure as e:
+            logger.warning('Keepalive failed: %s', str(e))
+            return False
+
+        return True
+
+
+    def put(self, localfile, remotefile, offset=0):
+        if offset:
+            logger.info('Resuming upload of %s to %s at %d bytes', localfile, remotefile, offset)
+        else:
+            logger.info('Uploading %s to %s', localfile, remotefile)
+
+        self._throttle_start = time.monotonic()
+        self._throttle_bytes = 0
+
+        self._put(localfile, remotefile, offset=offset)
+
+
+    def size(self, remotefile):
+        # returns None if the remote file does not exist
+        return self._size(remotefile)
+
+
+    def _throttle(self, sent_bytes):
+        # called after every block is sent
+        if not self.rate_limit:
+            return
+
+        self._throttle_bytes += sent_bytes
 
+        expected_s = self._throttle_bytes / float(self.rate_limit)
+        elapsed_s = time.monotonic() - self._throttle_start
 
-    def put(self, localfile, remotefile):
-        logger.info('Uploading %s to %s', localfile, remotefile)
-        self._put(localfile, remotefile)
+        if expected_s > elapsed_s:
+            time.sleep(expected_s - elapsed_s)
 
@@ -4,6 +4,7 @@ from .exceptions import ConnectionFailure
 from .exceptions import TransferFailure
 import paramiko
 import socket
+import io
 
 
 class sftp(GenericFileTransfer):
@@ -33,8 +34,14 @@ class sftp(GenericFileTransfer):
             raise ConnectionFailure(str(e)) from e
         except socket.timeout as e:
             raise ConnectionFailure(str(e)) from e
+        except (paramiko.ssh_exception.SSHException, EOFError, OSError) as e:
+            raise ConnectionFailure(str(e)) from e
 
-        self.sftp = client.open_sftp()
+        try:
+            self.sftp = client.open_sftp()
+        except (paramiko.ssh_exception.SSHException, EOFError, OSError) as e:
+            client.close()
+            raise ConnectionFailure(str(e)) from e
 
         return client
 
@@ -42,15 +49,64 @@ class sftp(GenericFileTransfer):
     def _close(self):
         if self.sftp:
             self.sftp.close()
+            self.sftp = None
 
         if self.client:
             self.client.close()
 
 
-    def _put(self, localfile, remotefile):
+    def _is_connected(self):
+        transport = self.client.get_transport()
+
+        if not transport:
+            return False
+
+        return transport.is_active()
+
+
+    def _keepalive(self):
+        try:
+            self.sftp.normalize('.')
+        except (paramiko.ssh_exception.SSHException, EOFError, OSError) as e:
+            raise ConnectionFailure(str(e)) from e
+
+
+    def _put(self, localfile, remotefile, offset=0):
         try:
-            self.sftp.put(str(localfile), str(remotefile))
+            f_localfile = io.open(str(localfile), 'rb')
+        except OSError as e:
+            raise TransferFailure(str(e)) from e
+
+        try:
+            with f_localfile:
+                f_localfile.seek(offset)
+
+                # existing file is not truncated when resuming
+                with self.sftp.open(str(remotefile), 'r+' if offset else 'w') as f_remotefile:
+                    f_remotefile.seek(offset)
+                    f_remotefile.set_pipelined(True)
+
+                    while True:
+                        data = f_localfile.read(self.block_size)
+                        if not data:
+                            break
+
+                        f_remotefile.write(data)
+                        self._throttle(len(data))
         except PermissionError as e:
             raise TransferFailure(str(e)) from e
+        except FileNotFoundError as e:
+            raise TransferFailure(str(e)) from e
+        except (paramiko.ssh_exception.SSHException, EOFError, OSError) as e:
+            # session is broken
+            raise ConnectionFailure(str(e)) from e
+
 
+    def _size(self, remotefile):
+        try:
+            return self.sftp.stat(str(remotefile)).st_size
+        except FileNotFoundError:
+            return None
+        except (paramiko.ssh_exception.SSHException, EOFError, OSError) as e:
+            raise ConnectionFailure(str(e)) from e
 
@@ -0,0 +1,70 @@
+import queue
+
+from multiprocessing import shared_memory
+from multiprocessing import Queue
+import multiprocessing
+
+
+logger = multiprocessing.get_logger()
+
+
+class FrameRingBuffer(object):
+    ### Fixed size frame slots in shared memory
+    # Free slot indexes are passed around in a queue.  The producer takes a slot, copies the
+    # frame in and sends the slot index to the image worker.  The worker returns the slot when
+    # finished.  When all slots are in use, the producer blocks.
+
+    def __init__(self, slots, slot_size):
+        self.slots = int(slots)
+        self.slot_size = int(slot_size)
+
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slots * self.slot_size)
+
+        self.free_q = Queue()
+        for slot in range(self.slots):
+            self.free_q.put(slot)
+
+        logger.info('Created frame buffer %s: %d slots x %d bytes', self.shm.name, self.slots, self.slot_size)
+
+
+    def put(self, data, timeout=None):
+        size = len(data)
+
+        if size > self.slot_size:
+            logger.warning('Frame too large for frame buffer slot: %d > %d', size, self.slot_size)
+            return None
+
+        try:
+            slot = self.free_q.get(timeout=timeout)
+        except queue.Empty:
+            logger.error('No free frame buffer slot after %0.1f s', timeout)
+            return None
+
+        offset = slot * self.slot_size
+        self.shm.buf[offset:offset + size] = data
+
+        # frames are only valid for the buffer they were written to
+        return { 'slot' : slot, 'size' : size, 'buffer' : self.name }
+
+
+    @property
+    def name(self):
+        return self.shm.name
+
+
+    def view(self, slot, size):
+        offset = slot * self.slot_size
+        return self.shm.buf[offset:offset + size]
+
+
+    def release(self, slot):
+        self.free_q.put(slot)
+
+
+    def close(self):
+        self.shm.close()
+
+
+    def unlink(self):
+        logger.info('Removing frame buffer %s', self.shm.name)
+        self.shm.unlink()
@@ -0,0 +1,281 @@
+import time
+import json
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import urlparse
+from urllib.parse import parse_qs
+
+from multiprocessing import Process
+import multiprocessing
+
+
+logger = multiprocessing.get_logger()
+
+
+CONTENT_TYPES = {
+    'jpg'  : 'image/jpeg',
+    'jpeg' : 'image/jpeg',
+    'png'  : 'image/png',
+    'tif'  : 'image/tiff',
+    'tiff' : 'image/tiff',
+}
+
+
+class LatestFrameServer(Process):
+    ### Serves the latest encoded frame and status from memory
+    # Frames are pushed by the image worker, only the newest frame is kept
+
+    def __init__(self, idx, config, frame_q):
+        super(LatestFrameServer, self).__init__()
+
+        #self.threadID = idx
+        self.name = 'LatestFrameServer{0:03d}'.format(idx)
+
+        self.config = config
+
+        self.frame_q = frame_q
+
+        self.frame = None
+        self.frame_cond = threading.Condition()
+
+        self.stats = {
+            'frames_received' : 0,
+            'requests'        : 0,
+            'not_modified'    : 0,
+            'stream_clients'  : 0,
+        }
+        self.stats_lock = threading.Lock()
+
+
+    def run(self):
+        http_config = self.config.get('HTTP_SERVER', {})
+
+        address = http_config.get('ADDRESS', '127.0.0.1')
+        port = int(http_config.get('PORT', 8080))
+
+        handler_class = type('LatestFrameHandler', (LatestFrameHandler,), {'frame_server' : self})
+
+        try:
+            httpd = ThreadingHTTPServer((address, port), handler_class)
+        except OSError as e:
+            logger.error('Unable to start HTTP server on %s:%d: %s', address, port, str(e))
+            return
+
+        httpd.daemon_threads = True
+
+        server_thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        server_thread.start()
+
+        logger.info('HTTP server listening on %s:%d', address, port)
+
+
+        while True:
+            f_dict = self.frame_q.get()
+
+            if f_dict.get('stop'):
+                httpd.shutdown()
+                httpd.server_close()
+
+                # wake up waiting clients
+                with self.frame_cond:
+                    self.frame = None
+                    self.frame_cond.notify_all()
+
+                return
+
+            self.updateFrame(f_dict)
+
+
+    def updateFrame(self, f_dict):
+        with self.stats_lock:
+            self.stats['frames_received'] += 1
+            frame_id = self.stats['frames_received']
+
+        frame = {
+            'id'           : frame_id,
+            'etag'         : '"{0:d}-{1:s}"'.format(frame_id, f_dict['time']),
+            'image'        : f_dict['image'],
+            'content_type' : CONTENT_TYPES.get(f_dict['image_type'], 'application/octet-stream'),
+            'status'       : json.dumps(f_dict['status'], indent=4).encode(),
+            'status_dict'  : f_dict['status'],
+            'received'     : time.time(),
+        }
+
+        with self.frame_cond:
+            self.frame = frame
+            self.frame_cond.notify_all()
+
+
+    def waitFrame(self, last_id, timeout):
+        # returns the latest frame, waiting for a newer frame than last_id
+        with self.frame_cond:
+            self.frame_cond.wait_for(lambda: self.frame and self.frame['id'] != last_id, timeout=timeout)
+            return self.frame
+
+
+    def incrementStat(self, key, value=1):
+        with self.stats_lock:
+            self.stats[key] += value
+
+
+
+class LatestFrameHandler(BaseHTTPRequestHandler):
+    frame_server = None  # set by LatestFrameServer
+    protocol_version = 'HTTP/1.1'
+
+    LONG_POLL_TIMEOUT = 60.0
+
+
+    def log_message(self, format, *args):
+        logger.debug('HTTP %s - %s', self.address_string(), format % args)
+
+
+    def do_GET(self):
+        self.frame_server.incrementStat('requests')
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path in ('/', '/latest') or url.path.startswith('/latest.'):
+            self.sendLatest('image', query)
+        elif url.path == '/status.json':
+            self.sendLatest('status', query)
+        elif url.path in ('/stream', '/stream.mjpg'):
+            self.sendStream()
+        elif url.path == '/metrics':
+            self.sendMetrics()
+        else:
+            self.send_error(404)
+
+
+    def sendLatest(self, key, query):
+        if 'wait' in query:
+            # long poll until the frame changes from the given etag
+            frame = self.frame_server.waitFrame(self._etagId(query['wait'][0]), self.LONG_POLL_TIMEOUT)
+        else:
+            frame = self.frame_server.frame
+
+        if not frame:
+            self.send_error(503, 'No frame available')
+            return
+
+        if self.headers.get('If-None-Match') == frame['etag']:
+            self.frame_server.incrementStat('not_modified')
+            self.send_response(304)
+            self.send_header('ETag', frame['etag'])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if key == 'image':
+            content_type = frame['content_type']
+        else:
+            content_type = 'application/json'
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(frame[key])))
+        self.send_header('ETag', frame['etag'])
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        self.wfile.write(frame[key])
+
+
+    def sendStream(self):
+        frame = self.frame_server.frame
+
+        if frame and frame['content_type'] != 'image/jpeg':
+            self.send_error(415, 'MJPEG stream requires jpg images')
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=frame')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        self.close_connection = True
+
+        self.frame_server.incrementStat('stream_clients')
+
+        last_id = None
+
+        try:
+            while True:
+                frame = self.frame_server.waitFrame(last_id, self.LONG_POLL_TIMEOUT)
+
+                if not frame:
+                    # server stopping
+                    return
+
+                if frame['id'] == last_id:
+                    # no new frame, keep the connection alive
+                    continue
+
+                last_id = frame['id']
+
+                self.wfile.write(b'--frame\r\n')
+                self.wfile.write('Content-Type: {0:s}\r\n'.format(frame['content_type']).encode())
+                self.wfile.write('Content-Length: {0:d}\r\n\r\n'.format(len(frame['image'])).encode())
+                self.wfile.write(frame['image'])
+                self.wfile.write(b'\r\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            logger.info('Stream client disconnected: %s', self.address_string())
+        finally:
+            self.frame_server.incrementStat('stream_clients', -1)
+
+
+    def sendMetrics(self):
+        with self.frame_server.stats_lock:
+            stats = dict(self.frame_server.stats)
+
+        frame = self.frame_server.frame
+
+        lines = list()
+        lines.append('indi_http_frames_received_total {0:d}'.format(stats['frames_received']))
+        lines.append('indi_http_requests_total {0:d}'.format(stats['requests']))
+        lines.append('indi_http_not_modified_total {0:d}'.format(stats['not_modified']))
+        lines.append('indi_http_stream_clients {0:d}'.format(stats['stream_clients']))
+
+        if frame:
+            status = frame['status_dict']
+
+            lines.append('indi_frame_age_seconds {0:0.3f}'.format(time.time() - frame['received']))
+            lines.append('indi_frame_bytes {0:d}'.format(len(frame['image'])))
+
+            for k in ('exposure', 'gain', 'temp', 'current_adu', 'night'):
+                if status.get(k) is not None:
+                    lines.append('indi_{0:s} {1:f}'.format(k, float(status[k])))
+
+            for stage, stage_stats in status.get('timing', {}).items():
+                for stat, value in stage_stats.items():
+                    lines.append('indi_stage_{0:s}{{stage="{1:s}"}} {2:f}'.format(stat, stage, value))
+
+            for q_name, q_size in status.get('queue', {}).items():
+                lines.append('indi_queue_depth{{queue="{0:s}"}} {1:d}'.format(q_name, q_size))
+
+            scheduler = status.get('scheduler')
+            if scheduler:
+                lines.append('indi_scheduler_slots_total {0:d}'.format(scheduler['slots']))
+                lines.append('indi_scheduler_missed_slots_total {0:d}'.format(scheduler['missed']))
+
+
+        body = ('\n'.join(lines) + '\n').encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        self.wfile.write(body)
+
+
+    def _etagId(self, etag):
+        try:
+            return int(etag.strip('"').split('-')[0])
+        except ValueError:
+            return None
+
@@ -1,15 +1,15 @@
+import os
 import io
+import time
 import json
 from pathlib import Path
-from datetime import datetime
 from datetime import timedelta
 import functools
 import tempfile
-import shutil
+import queue
 import copy
-import math
 
-import ephem
+from concurrent.futures import ThreadPoolExecutor
 
 from multiprocessing import Process
 #from threading import Thread
@@ -19,12 +19,19 @@ from astropy.io import fits
 import cv2
 import numpy
 
+from .darks import DarkLibrary
+from . import fastfits
+from .overlay import OverlayRenderer
+from .bufferpool import BufferPool
+from .timing import StageTimer
+from .catalog import ImageCatalog
+
 
 logger = multiprocessing.get_logger()
 
 
 class ImageProcessWorker(Process):
-    def __init__(self, idx, config, image_q, upload_q, exposure_v, gain_v, bin_v, sensortemp_v, night_v, save_fits=False, save_images=True):
+    def __init__(self, idx, config, image_q, upload_q, exposure_v, gain_v, bin_v, sensortemp_v, night_v, save_fits=False, save_images=True, compress_fits=True, frame_buffer=None, upload_elapsed_v=None, upload_count_v=None, slot_count_v=None, missed_slots_v=None, http_frame_q=None):
         super(ImageProcessWorker, self).__init__()
 
         #self.threadID = idx
@@ -38,114 +45,233 @@ class ImageProcessWorker(Process):
         self.bin_v = bin_v
         self.sensortemp_v = sensortemp_v
         self.night_v = night_v
+        self.frame_buffer = frame_buffer
+        self.upload_elapsed_v = upload_elapsed_v
+        self.upload_count_v = upload_count_v
+        self.slot_count_v = slot_count_v
+        self.missed_slots_v = missed_slots_v
+        self.upload_count = 0
+        self.http_frame_q = http_frame_q
 
         self.last_exposure = None
 
         self.filename_t = '{0:s}.{1:s}'
         self.save_fits = save_fits
         self.save_images = save_images
+        self.compress_fits = compress_fits
+
+        self.fits_executor = None  # started in the worker process
+        self.fits_futures = []
 
         self.target_adu_found = False
         self.current_adu_target = 0
         self.hist_adu = []
+        self.adu_percentiles = dict()
         self.target_adu = float(self.config['TARGET_ADU'])
         self.target_adu_dev = float(self.config['TARGET_ADU_DEV'])
 
+        self.overlay = None  # created in the worker process
+        self.clahe = None
+
+        self.buffer_pool = BufferPool()
+
+        self.last_status = None
+
+        self.timer = StageTimer()
+
+        self.scale_lut = None
+        self.scale_lut_key = None
+
         self.image_count = 0
         self.image_width = 0
         self.image_height = 0
 
         self.base_dir = Path(__file__).parent.parent.absolute()
 
+        self.catalog = None  # opened in the worker process
+
+        self.dark_library = DarkLibrary(
+            self.base_dir.joinpath('darks'),
+            max_bytes=int(self.config.get('DARK_LIBRARY_MAX_MB', 512)) * 1048576,
+        )
+
 
     def run(self):
+        if self.config.get('IMAGE_CATALOG', True):
+            self.catalog = ImageCatalog(self.base_dir.joinpath('catalog.sqlite'), self.base_dir)
+
         while True:
             i_dict = self.image_q.get()
 
             if i_dict.get('stop'):
+                if self.fits_executor:
+                    self.fits_executor.shutdown(wait=True)  # finish pending fits files
+
+                if self.frame_buffer:
+                    self.frame_buffer.close()
+
+                if self.catalog:
+                    self.catalog.close()
                 return
 
-            imgdata = i_dict['imgdata']
+            frame_slot = i_dict.get('slot')
+
+            if frame_slot is not None:
+                if i_dict.get('buffer') != self.frame_buffer.name:
+                    # buffer was replaced after a worker failure
+                    logger.warning('Dropping frame from previous frame buffer %s', i_dict.get('buffer'))
+                    continue
+
+                # frame data is in shared memory
+                imgdata = self.frame_buffer.view(frame_slot, i_dict['size'])
+            else:
+                imgdata = i_dict['imgdata']
+
             exp_date = i_dict['exp_date']
             filename_t = i_dict.get('filename_t')
 
             if filename_t:
                 self.filename_t = filename_t
 
-            self.image_count += 1
+            if i_dict.get('download_s') is not None:
+                self.timer.record('download', i_dict['download_s'])
+
+            if i_dict.get('queued') is not None:
+                # monotonic clock is system wide
+                self.timer.record('queue_wait', time.monotonic() - i_dict['queued'])
+
+            try:
+                self.processImage(imgdata, exp_date)
+            finally:
+                if frame_slot is not None:
+                    # the view must not outlive the slot, arrays created from it are released by now
+                    try:
+                        imgdata.release()
+                    except BufferError:
+                        logger.warning('Frame buffer view is still in use')
+
+                    del imgdata
+                    self.frame_buffer.release(frame_slot)  # slot may be reused
+
 
-            # Save last exposure value for picture
-            self.last_exposure = self.exposure_v.value
+    def processImage(self, imgdata, exp_date):
+        self.image_count += 1
 
-            ### OpenCV ###
-            blobfile = io.BytesIO(imgdata)
-            hdulist = fits.open(blobfile)
-            scidata_uncalibrated = hdulist[0].data
+        # Save last exposure value for picture
+        self.last_exposure = self.exposure_v.value
 
-            self.image_height, self.image_width = scidata_uncalibrated.shape
-            logger.info('Image: %d x %d', self.image_width, self.image_height)
+        # must be written before decoding, 16 bit data is byte swapped in place
+        if self.save_fits:
+            self.write_fit(imgdata, exp_date)
 
-            if self.save_fits:
-                self.write_fit(hdulist, exp_date)
+        ### OpenCV ###
+        with self.timer.stage('decode'):
+            scidata_uncalibrated = self.decode(imgdata)
 
+        self.buffer_pool.reset(scidata_uncalibrated.shape, scidata_uncalibrated.dtype)
+
+        self.image_height, self.image_width = scidata_uncalibrated.shape[:2]
+        logger.info('Image: %d x %d', self.image_width, self.image_height)
+
+        with self.timer.stage('calibrate'):
             scidata_calibrated = self.calibrate(scidata_uncalibrated)
+
+        with self.timer.stage('debayer'):
             scidata_color = self.debayer(scidata_calibrated)
 
-            #scidata_blur = self.median_blur(scidata_color)
-            scidata_blur = scidata_color
+        with self.timer.stage('stats'):
+            adu, adu_average = self.calculate_histogram(scidata_color, data_bayer=scidata_calibrated)  # calculate based on pre_blur data
 
-            adu, adu_average = self.calculate_histogram(scidata_color)  # calculate based on pre_blur data
+        if scidata_color.dtype == numpy.uint16 and not self.write_16bit():
+            with self.timer.stage('scale'):
+                scidata_scaled = self.scale_8bit(scidata_color)
 
-            #scidata_denoise = cv2.fastNlMeansDenoisingColored(
-            #    scidata_color,
-            #    None,
-            #    h=3,
-            #    hColor=3,
-            #    templateWindowSize=7,
-            #    searchWindowSize=21,
-            #)
+                if self.daytime_contrast():
+                    # 16 bit data is enhanced after scaling
+                    scidata_scaled = self.contrast_clahe(scidata_scaled)
+        else:
+            scidata_scaled = scidata_color
+
+        #scidata_blur = self.median_blur(scidata_scaled)
+        scidata_blur = scidata_scaled
+
+        #scidata_denoise = cv2.fastNlMeansDenoisingColored(
+        #    scidata_color,
+        #    None,
+        #    h=3,
+        #    hColor=3,
+        #    templateWindowSize=7,
+        #    searchWindowSize=21,
+        #)
 
+        with self.timer.stage('overlay'):
             self.image_text(scidata_blur, exp_date)
 
-            self.write_status_json(exp_date, adu, adu_average)  # write json status file
+        img_encoded = None
+        latest_file = None
 
-            if self.save_images:
-                latest_file = self.write_img(scidata_blur, exp_date)
+        if self.save_images:
+            img_encoded = self.encode_img(scidata_blur)
 
-                if not self.config['FILETRANSFER']['UPLOAD_IMAGE']:
-                    logger.warning('Image uploading disabled')
-                    continue
+        if img_encoded is not None:
+            latest_file = self.write_img(scidata_blur, exp_date, adu=adu, img_encoded=img_encoded)
 
-                if (self.image_count % int(self.config['FILETRANSFER']['UPLOAD_IMAGE'])) != 0:
-                    # upload every X image
-                    continue
+        # after the files are written so the timings include this frame
+        self.write_status_json(exp_date, adu, adu_average)  # write json status file
 
+        if img_encoded is not None:
+            self.publish_frame(img_encoded, exp_date)
 
-                remote_path = Path(self.config['FILETRANSFER']['REMOTE_IMAGE_FOLDER'])
-                remote_file = remote_path.joinpath(self.config['FILETRANSFER']['REMOTE_IMAGE_NAME'].format(self.config['IMAGE_FILE_TYPE']))
+        if not latest_file:
+            # nothing written
+            return
 
-                # tell worker to upload file
-                self.upload_q.put({ 'local_file' : latest_file, 'remote_file' : remote_file })
+        if not self.config['FILETRANSFER']['UPLOAD_IMAGE']:
+            logger.warning('Image uploading disabled')
+            return
 
+        if (self.image_count % int(self.config['FILETRANSFER']['UPLOAD_IMAGE'])) != 0:
+            # upload every X image
+            return
 
 
+        remote_name = self.config['FILETRANSFER']['REMOTE_IMAGE_NAME'].format(self.config['IMAGE_FILE_TYPE'])
+
+        # tell worker to upload file, the remote folder is set per destination
+        # pending uploads of the same remote file are replaced
+        self.upload_q.put({ 'local_file' : latest_file, 'remote_name' : remote_name, 'type' : 'image', 'key' : remote_name })
 
-    def write_fit(self, hdulist, exp_date):
-        ### Do not write image files if fits are enabled
-        if not self.save_fits:
-            return
 
 
-        f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.fit')
 
-        hdulist.writeto(f_tmpfile)
+    def decode(self, imgdata):
+        scidata = fastfits.decode(imgdata)
 
-        f_tmpfile.flush()
-        f_tmpfile.close()
+        if scidata is not None:
+            return scidata
+
+        logger.warning('Decoding FITS data with astropy')
+        blobfile = io.BytesIO(imgdata)
+        hdulist = fits.open(blobfile)
+        return hdulist[0].data
+
+
+    def write_fit(self, imgdata, exp_date):
+        ### Do not write image files if fits are enabled
+        if not self.save_fits:
+            return
 
 
         date_str = exp_date.strftime('%Y%m%d_%H%M%S')
-        filename = self.base_dir.joinpath(self.filename_t.format(date_str, 'fit'))
+
+        compression = None
+        if self.compress_fits:
+            compression = self.config.get('FITS_COMPRESSION')
+
+        if compression:
+            filename = self.base_dir.joinpath(self.filename_t.format(date_str, 'fit.fz'))
+        else:
+            filename = self.base_dir.joinpath(self.filename_t.format(date_str, 'fit'))
 
         logger.info('fit filename: %s', filename)
 
@@ -153,54 +279,107 @@ class ImageProcessWorker(Process):
             logger.error('File exists: %s (skipping)', filename)
             return
 
-        shutil.copy2(f_tmpfile.name, str(filename))  # copy file in place
-        filename.chmod(0o644)
 
-        Path(f_tmpfile.name).unlink()  # delete temp file
+        if compression:
+            fits_threads = int(self.config.get('FITS_COMPRESSION_THREADS', 1))
+
+            if not self.fits_executor:
+                self.fits_executor = ThreadPoolExecutor(max_workers=fits_threads)
+
+            # remove finished jobs
+            self.fits_futures = [f for f in self.fits_futures if not f.done()]
+
+            if len(self.fits_futures) < fits_threads * 2:
+                # copy data, the frame buffer slot is reused
+                future = self.fits_executor.submit(self._write_fit_compressed, bytes(imgdata), filename, compression, exp_date)
+                self.fits_futures.append(future)
+                return
+
+            logger.warning('FITS compression backlog, writing uncompressed fit')
+            filename = filename.with_suffix('')  # remove .fz
+
+
+        self._write_file_atomic(filename, imgdata)  # blob data is already a FITS file
+
+        self.catalogAdd(filename, exp_date, 'fit', len(imgdata))
 
         logger.info('Finished writing fit file')
 
 
-    def write_img(self, scidata, exp_date):
-        ### Do not write image files if fits are enabled
-        if not self.save_images:
+    def _write_fit_compressed(self, imgdata, filename, compression, exp_date):
+        try:
+            hdulist = fits.open(io.BytesIO(imgdata))
+
+            comp_hdu = fits.CompImageHDU(
+                data=hdulist[0].data,
+                header=hdulist[0].header,
+                compression_type=compression,
+            )
+
+            f_fit = io.BytesIO()
+            fits.HDUList([fits.PrimaryHDU(), comp_hdu]).writeto(f_fit)
+
+            self._write_file_atomic(filename, f_fit.getbuffer())
+        except Exception as e:
+            logger.error('Failed to write compressed fit %s: %s', filename, str(e))
             return
 
+        self.catalogAdd(filename, exp_date, 'fit', f_fit.getbuffer().nbytes)
 
-        f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.{0}'.format(self.config['IMAGE_FILE_TYPE']))
-        f_tmpfile.close()
+        logger.info('Finished writing compressed fit file: %s', filename)
 
-        tmpfile_name = Path(f_tmpfile.name)
-        tmpfile_name.unlink()  # remove tempfile, will be reused below
 
+    def encode_img(self, scidata):
+        encode_start = time.monotonic()
 
-        # write to temporary file
+        # encode once in memory
         if self.config['IMAGE_FILE_TYPE'] in ('jpg', 'jpeg'):
-            cv2.imwrite(str(tmpfile_name), scidata, [cv2.IMWRITE_JPEG_QUALITY, self.config['IMAGE_FILE_COMPRESSION'][self.config['IMAGE_FILE_TYPE']]])
+            result, img_encoded = cv2.imencode('.jpg', scidata, [cv2.IMWRITE_JPEG_QUALITY, self.config['IMAGE_FILE_COMPRESSION'][self.config['IMAGE_FILE_TYPE']]])
         elif self.config['IMAGE_FILE_TYPE'] in ('png',):
-            cv2.imwrite(str(tmpfile_name), scidata, [cv2.IMWRITE_PNG_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION'][self.config['IMAGE_FILE_TYPE']]])
+            result, img_encoded = cv2.imencode('.png', scidata, [cv2.IMWRITE_PNG_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION'][self.config['IMAGE_FILE_TYPE']]])
         elif self.config['IMAGE_FILE_TYPE'] in ('tif', 'tiff'):
-            cv2.imwrite(str(tmpfile_name), scidata)
+            result, img_encoded = cv2.imencode('.tif', scidata)
         else:
             raise Exception('Unknown file type: %s', self.config['IMAGE_FILE_TYPE'])
 
+        if not result:
+            logger.error('Failed to encode image')
+            return
 
-        ### Always write the latest file for web access
-        latest_file = self.base_dir.joinpath('images', 'latest.{0:s}'.format(self.config['IMAGE_FILE_TYPE']))
+        self.timer.record('encode', time.monotonic() - encode_start)
+
+        return img_encoded
+
+
+    def write_img(self, scidata, exp_date, adu=None, img_encoded=None):
+        ### Do not write image files if fits are enabled
+        if not self.save_images:
+            return
+
+        if img_encoded is None:
+            img_encoded = self.encode_img(scidata)
+
+            if img_encoded is None:
+                return
+
+
+        write_start = time.monotonic()
 
-        try:
-            latest_file.unlink()
-        except FileNotFoundError:
-            pass
 
-        shutil.copy2(str(tmpfile_name), str(latest_file))
-        latest_file.chmod(0o644)
+        ### Always write the latest file for web access
+        latest_file = self.base_dir.joinpath('images', 'latest.{0:s}'.format(self.config['IMAGE_FILE_TYPE']))
 
 
         ### Do not write daytime image files if daytime timelapse is disabled
         if not self.night_v.value and not self.config['DAYTIME_TIMELAPSE']:
             logger.info('Daytime timelapse is disabled')
-            tmpfile_name.unlink()  # cleanup temp file
+
+            if not self.write_latest() and not self.config['FILETRANSFER']['UPLOAD_IMAGE']:
+                # latest frame is only served from memory
+                return
+
+            self._write_file_atomic(latest_file, img_encoded)
+            self.timer.record('write', time.monotonic() - write_start)
             logger.info('Finished writing files')
             return latest_file
 
@@ -215,20 +394,92 @@ class ImageProcessWorker(Process):
 
         if filename.exists():
             logger.error('File exists: %s (skipping)', filename)
-            return
 
-        shutil.copy2(str(tmpfile_name), str(filename))
-        filename.chmod(0o644)
+            if not self.write_latest():
+                return filename
+
+            self._write_file_atomic(latest_file, img_encoded)
+            return latest_file
+
+        self._write_file_atomic(filename, img_encoded)
+
+        self.catalogAdd(filename, exp_date, 'image', len(img_encoded), adu=adu, width=scidata.shape[1], height=scidata.shape[0])
+
+
+        if not self.write_latest():
+            # upload the timelapse file instead
+            self.timer.record('write', time.monotonic() - write_start)
+            logger.info('Finished writing files')
+            return filename
+
 
+        # latest is a hard link to the timelapse file, replaced atomically
+        self._link_file_atomic(filename, latest_file, img_encoded)
 
-        ### Cleanup
-        tmpfile_name.unlink()
+        self.timer.record('write', time.monotonic() - write_start)
 
         logger.info('Finished writing files')
 
         return latest_file
 
 
+    def catalogAdd(self, filename, exp_date, image_type, size, adu=None, width=None, height=None):
+        if not self.catalog:
+            return
+
+        self.catalog.addImage(
+            filename,
+            exp_date,
+            self.getDayDate(exp_date),
+            self.night_v.value,
+            image_type=image_type,
+            exposure=self.last_exposure,
+            gain=self.gain_v.value,
+            binmode=self.bin_v.value,
+            adu=adu,
+            size=size,
+            width=width,
+            height=height,
+        )
+
+
+    def _write_file_atomic(self, filename, data):
+        # temp file in the same folder so the rename is atomic
+        f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, dir=str(filename.parent), prefix='.', suffix=filename.suffix)
+
+        try:
+            f_tmpfile.write(data)
+            f_tmpfile.flush()
+            f_tmpfile.close()
+
+            tmpfile_name = Path(f_tmpfile.name)
+            tmpfile_name.chmod(0o644)
+            tmpfile_name.replace(filename)
+        except OSError:
+            f_tmpfile.close()
+            Path(f_tmpfile.name).unlink()
+            raise
+
+
+    def _link_file_atomic(self, filename, link_file, data):
+        tmplink_name = link_file.parent.joinpath('.{0:s}.{1:d}'.format(link_file.name, os.getpid()))
+
+        try:
+            tmplink_name.unlink()
+        except FileNotFoundError:
+            pass
+
+        try:
+            os.link(str(filename), str(tmplink_name))
+        except OSError as e:
+            # hard links not supported, write another copy
+            logger.warning('Unable to link %s: %s', link_file, str(e))
+            self._write_file_atomic(link_file, data)
+            return
+
+        tmplink_name.replace(link_file)
+
+
     def write_status_json(self, exp_date, adu, adu_average):
         status = {
             'name'                : 'indi_json',
@@ -247,26 +498,94 @@ class ImageProcessWorker(Process):
         }
 
 
+        status.update(self.adu_percentiles)
+
+        if self.upload_count_v and self.upload_count_v.value != self.upload_count:
+            # new upload completed
+            self.upload_count = self.upload_count_v.value
+            self.timer.record('upload', self.upload_elapsed_v.value)
+
+        status['timing'] = self.timer.stats()
+        status['queue'] = {
+            'image'  : self._queue_size(self.image_q),
+            'upload' : self._queue_size(self.upload_q),
+        }
+
+        if self.slot_count_v:
+            with self.slot_count_v.get_lock():
+                status['scheduler'] = {
+                    'slots'  : self.slot_count_v.value,
+                    'missed' : self.missed_slots_v.value,
+                }
+
+        self.last_status = status
+
+
+        if not self.write_latest():
+            # status is only served from memory
+            return
+
+
         with io.open('/tmp/indi_status.json', 'w') as f_indi_status:
             json.dump(status, f_indi_status, indent=4)
             f_indi_status.flush()
             f_indi_status.close()
 
 
-    def getImageFolder(self, exp_date):
+    def write_latest(self):
+        # latest files are not needed when served by the HTTP server
+        if not self.http_frame_q:
+            return True
+
+        return self.config.get('HTTP_SERVER', {}).get('WRITE_FILES', True)
+
+
+    def publish_frame(self, img_encoded, exp_date):
+        if not self.http_frame_q:
+            return
+
+        f_dict = {
+            'image'      : img_encoded.tobytes(),
+            'image_type' : self.config['IMAGE_FILE_TYPE'],
+            'status'     : self.last_status,
+            'time'       : exp_date.strftime('%s'),
+        }
+
+        try:
+            self.http_frame_q.put_nowait(f_dict)
+        except queue.Full:
+            logger.warning('HTTP server queue is full, frame not published')
+
+
+    def _queue_size(self, q):
+        try:
+            return q.qsize()
+        except NotImplementedError:
+            # not available on all platforms
+            return -1
+
+
+    def getDayDate(self, exp_date):
         if self.night_v.value:
             # images should be written to previous day's folder until noon
             day_ref = exp_date - timedelta(hours=12)
-            timeofday_str = 'night'
         else:
             # daytime
             # images should be written to current day's folder
             day_ref = exp_date
+
+        return day_ref.strftime('%Y%m%d')
+
+
+    def getImageFolder(self, exp_date):
+        if self.night_v.value:
+            timeofday_str = 'night'
+        else:
             timeofday_str = 'day'
 
         hour_str = exp_date.strftime('%d_%H')
 
-        day_folder = self.base_dir.joinpath('images', '{0:s}'.format(day_ref.strftime('%Y%m%d')), timeofday_str)
+        day_folder = self.base_dir.joinpath('images', '{0:s}'.format(self.getDayDate(exp_date)), timeofday_str)
         if not day_folder.exists():
             day_folder.mkdir(parents=True)
             day_folder.chmod(0o755)
@@ -281,15 +600,22 @@ class ImageProcessWorker(Process):
 
     def calibrate(self, scidata_uncalibrated):
 
-        dark_file = self.base_dir.joinpath('darks', 'dark_{0:d}s_gain{1:d}_bin{2:d}.fit'.format(int(self.last_exposure), self.gain_v.value, self.bin_v.value))
+        dark_data = self.dark_library.get(self.last_exposure, self.gain_v.value, self.bin_v.value)
 
-        if not dark_file.exists():
-            logger.warning('Dark not found: %s', dark_file)
+        if dark_data is None:
+            logger.warning('Dark not found: %s', self.dark_library.getDarkFile(self.last_exposure, self.gain_v.value, self.bin_v.value))
             return scidata_uncalibrated
 
-        with fits.open(str(dark_file)) as dark:
-            scidata = cv2.subtract(scidata_uncalibrated, dark[0].data)
-            del dark[0].data   # make sure memory is freed
+        if dark_data.dtype != scidata_uncalibrated.dtype:
+            logger.warning('Dark data type %s does not match image data type %s', dark_data.dtype, scidata_uncalibrated.dtype)
+            return scidata_uncalibrated
+
+        # saturates at 0 for both 8 and 16 bit data
+        scidata = cv2.subtract(
+            scidata_uncalibrated,
+            dark_data,
+            dst=self.buffer_pool.get('calibrate', scidata_uncalibrated.shape, scidata_uncalibrated.dtype),
+        )
 
         return scidata
 
@@ -302,15 +628,17 @@ class ImageProcessWorker(Process):
         bayer_pattern = getattr(cv2, self.config['IMAGE_DEBAYER'])
         ###
         #scidata_rgb = cv2.cvtColor(scidata, cv2.COLOR_BayerGR2RGB)
-        scidata_rgb = cv2.cvtColor(scidata, bayer_pattern)
+        scidata_rgb = cv2.cvtColor(
+            scidata,
+            bayer_pattern,
+            dst=self.buffer_pool.get('debayer', scidata.shape[:2] + (3,), scidata.dtype),
+        )  # 8 or 16 bit
         ###
 
-        #scidata_rgb = self._convert_GRBG_to_RGB_8bit(scidata)
-
         #scidata_wb = self.white_balance2(scidata_rgb)
         scidata_wb = scidata_rgb
 
-        if not self.night_v.value and self.config['DAYTIME_CONTRAST_ENHANCE']:
+        if self.daytime_contrast() and scidata_wb.dtype == numpy.uint8:
             # Contrast enhancement during the day
             scidata_contrast = self.contrast_clahe(scidata_wb)
         else:
@@ -324,194 +652,69 @@ class ImageProcessWorker(Process):
         return scidata_contrast
 
 
-    def image_text(self, data_bytes, exp_date):
-        # not sure why these are returned as tuples
-        fontFace = getattr(cv2, self.config['TEXT_PROPERTIES']['FONT_FACE']),
-        lineType = getattr(cv2, self.config['TEXT_PROPERTIES']['FONT_AA']),
-
-        sunOrbX, sunOrbY = self.getOrbXY(ephem.Sun())
-
-        # Sun outline
-        cv2.circle(
-            img=data_bytes,
-            center=(sunOrbX, sunOrbY),
-            radius=self.config['ORB_PROPERTIES']['RADIUS'],
-            color=(0, 0, 0),
-            thickness=cv2.FILLED,
-        )
-        # Draw sun
-        cv2.circle(
-            img=data_bytes,
-            center=(sunOrbX, sunOrbY),
-            radius=self.config['ORB_PROPERTIES']['RADIUS'] - 1,
-            color=self.config['ORB_PROPERTIES']['SUN_COLOR'],
-            thickness=cv2.FILLED,
-        )
+    def daytime_contrast(self):
+        return not self.night_v.value and self.config['DAYTIME_CONTRAST_ENHANCE']
 
 
-        moonOrbX, moonOrbY = self.getOrbXY(ephem.Moon())
+    def write_16bit(self):
+        if self.config.get('IMAGE_FILE_BIT_DEPTH', 8) != 16:
+            return False
 
-        # Moon outline
-        cv2.circle(
-            img=data_bytes,
-            center=(moonOrbX, moonOrbY),
-            radius=self.config['ORB_PROPERTIES']['RADIUS'],
-            color=(0, 0, 0),
-            thickness=cv2.FILLED,
-        )
-        # Draw moon
-        cv2.circle(
-            img=data_bytes,
-            center=(moonOrbX, moonOrbY),
-            radius=self.config['ORB_PROPERTIES']['RADIUS'] - 1,
-            color=self.config['ORB_PROPERTIES']['MOON_COLOR'],
-            thickness=cv2.FILLED,
-        )
+        if self.config['IMAGE_FILE_TYPE'] not in ('png', 'tif', 'tiff'):
+            logger.warning('16 bit images are only supported for png and tif files')
+            return False
 
-        #cv2.rectangle(
-        #    img=data_bytes,
-        #    pt1=(0, 0),
-        #    pt2=(350, 125),
-        #    color=(0, 0, 0),
-        #    thickness=cv2.FILLED,
-        #)
+        return True
 
-        line_offset = 0
-
-        if self.config['TEXT_PROPERTIES']['FONT_OUTLINE']:
-            cv2.putText(
-                img=data_bytes,
-                text=exp_date.strftime('%Y%m%d %H:%M:%S'),
-                org=(self.config['TEXT_PROPERTIES']['FONT_X'], self.config['TEXT_PROPERTIES']['FONT_Y'] + line_offset),
-                fontFace=fontFace[0],
-                color=(0, 0, 0),
-                lineType=lineType[0],
-                fontScale=self.config['TEXT_PROPERTIES']['FONT_SCALE'],
-                thickness=self.config['TEXT_PROPERTIES']['FONT_THICKNESS'] + 1,
-            )  # black outline
-        cv2.putText(
-            img=data_bytes,
-            text=exp_date.strftime('%Y%m%d %H:%M:%S'),
-            org=(self.config['TEXT_PROPERTIES']['FONT_X'], self.config['TEXT_PROPERTIES']['FONT_Y'] + line_offset),
-            fontFace=fontFace[0],
-            color=self.config['TEXT_PROPERTIES']['FONT_COLOR'],
-            lineType=lineType[0],
-            fontScale=self.config['TEXT_PROPERTIES']['FONT_SCALE'],
-            thickness=self.config['TEXT_PROPERTIES']['FONT_THICKNESS'],
-        )
 
+    def max_value(self, scidata):
+        if scidata.dtype == numpy.uint16:
+            return (2 ** int(self.config.get('IMAGE_BIT_DEPTH', 16))) - 1
 
-        line_offset += self.config['TEXT_PROPERTIES']['FONT_HEIGHT']
-
-        if self.config['TEXT_PROPERTIES']['FONT_OUTLINE']:
-            cv2.putText(
-                img=data_bytes,
-                text='Exposure {0:0.6f}'.format(self.last_exposure),
-                org=(self.config['TEXT_PROPERTIES']['FONT_X'], self.config['TEXT_PROPERTIES']['FONT_Y'] + line_offset),
-                fontFace=fontFace[0],
-                color=(0, 0, 0),
-                lineType=lineType[0],
-                fontScale=self.config['TEXT_PROPERTIES']['FONT_SCALE'],
-                thickness=self.config['TEXT_PROPERTIES']['FONT_THICKNESS'] + 1,
-            )  # black outline
-        cv2.putText(
-            img=data_bytes,
-            text='Exposure {0:0.6f}'.format(self.last_exposure),
-            org=(self.config['TEXT_PROPERTIES']['FONT_X'], self.config['TEXT_PROPERTIES']['FONT_Y'] + line_offset),
-            fontFace=fontFace[0],
-            color=self.config['TEXT_PROPERTIES']['FONT_COLOR'],
-            lineType=lineType[0],
-            fontScale=self.config['TEXT_PROPERTIES']['FONT_SCALE'],
-            thickness=self.config['TEXT_PROPERTIES']['FONT_THICKNESS'],
-        )
+        return 255
 
 
-        line_offset += self.config['TEXT_PROPERTIES']['FONT_HEIGHT']
-
-        if self.config['TEXT_PROPERTIES']['FONT_OUTLINE']:
-            cv2.putText(
-                img=data_bytes,
-                text='Gain {0:d}'.format(self.gain_v.value),
-                org=(self.config['TEXT_PROPERTIES']['FONT_X'], self.config['TEXT_PROPERTIES']['FONT_Y'] + line_offset),
-                fontFace=fontFace[0],
-                color=(0, 0, 0),
-                lineType=lineType[0],
-                fontScale=self.config['TEXT_PROPERTIES']['FONT_SCALE'],
-                thickness=self.config['TEXT_PROPERTIES']['FONT_THICKNESS'] + 1,
-            )  # black outline
-        cv2.putText(
-            img=data_bytes,
-            text='Gain {0:d}'.format(self.gain_v.value),
-            org=(self.config['TEXT_PROPERTIES']['FONT_X'], self.config['TEXT_PROPERTIES']['FONT_Y'] + line_offset),
-            fontFace=fontFace[0],
-            color=self.config['TEXT_PROPERTIES']['FONT_COLOR'],
-            lineType=lineType[0],
-            fontScale=self.config['TEXT_PROPERTIES']['FONT_SCALE'],
-            thickness=self.config['TEXT_PROPERTIES']['FONT_THICKNESS'],
-        )
+    def scale_8bit(self, scidata):
+        if scidata.dtype == numpy.uint8:
+            return scidata
 
+        lut_key = (self.max_value(scidata), float(self.config.get('IMAGE_SCALE_GAMMA', 1.0)))
 
-        # Add temp if value is set, will be skipped if the temp is exactly 0
-        if self.sensortemp_v.value:
-            line_offset += self.config['TEXT_PROPERTIES']['FONT_HEIGHT']
-
-            if self.config['TEXT_PROPERTIES']['FONT_OUTLINE']:
-                cv2.putText(
-                    img=data_bytes,
-                    text='Temp {0:0.1f}'.format(self.sensortemp_v.value),
-                    org=(self.config['TEXT_PROPERTIES']['FONT_X'], self.config['TEXT_PROPERTIES']['FONT_Y'] + line_offset),
-                    fontFace=fontFace[0],
-                    color=(0, 0, 0),
-                    lineType=lineType[0],
-                    fontScale=self.config['TEXT_PROPERTIES']['FONT_SCALE'],
-                    thickness=self.config['TEXT_PROPERTIES']['FONT_THICKNESS'] + 1,
-                )  # black outline
-            cv2.putText(
-                img=data_bytes,
-                text='Temp {0:0.1f}'.format(self.sensortemp_v.value),
-                org=(self.config['TEXT_PROPERTIES']['FONT_X'], self.config['TEXT_PROPERTIES']['FONT_Y'] + line_offset),
-                fontFace=fontFace[0],
-                color=self.config['TEXT_PROPERTIES']['FONT_COLOR'],
-                lineType=lineType[0],
-                fontScale=self.config['TEXT_PROPERTIES']['FONT_SCALE'],
-                thickness=self.config['TEXT_PROPERTIES']['FONT_THICKNESS'],
-            )
+        if self.scale_lut_key != lut_key:
+            max_value, gamma = lut_key
+            logger.info('Building 16 bit scaling table: max %d, gamma %0.2f', max_value, gamma)
 
+            lut_f = numpy.clip(numpy.arange(65536, dtype=numpy.float32) / max_value, 0.0, 1.0)
 
-    def calculate_histogram(self, data_bytes):
-        if self.config['ADU_ROI']:
-            logger.warn('Calculating ADU from RoI')
-            # divide the coordinates by binning value
-            x1 = int(self.config['ADU_ROI'][0] / self.bin_v.value)
-            y1 = int(self.config['ADU_ROI'][1] / self.bin_v.value)
-            x2 = int(self.config['ADU_ROI'][2] / self.bin_v.value)
-            y2 = int(self.config['ADU_ROI'][3] / self.bin_v.value)
+            if gamma != 1.0:
+                lut_f = numpy.power(lut_f, 1.0 / gamma)
 
-            scidata = data_bytes[
-                y1:(y1 + y2),
-                x1:(x1 + x2),
-            ]
-        else:
-            scidata = data_bytes
+            self.scale_lut = numpy.rint(lut_f * 255).astype(numpy.uint8)
+            self.scale_lut_key = lut_key
 
-        if not self.config['IMAGE_DEBAYER']:
-            m_avg = cv2.mean(scidata)[0]
+        return numpy.take(self.scale_lut, scidata, out=self.buffer_pool.get('scale_8bit', scidata.shape, numpy.uint8))
 
-            logger.info('Greyscale mean: %0.2f', m_avg)
 
-            adu = m_avg
-        else:
-            r, g, b = cv2.split(scidata)
-            r_avg = cv2.mean(r)[0]
-            g_avg = cv2.mean(g)[0]
-            b_avg = cv2.mean(b)[0]
+    def image_text(self, data_bytes, exp_date):
+        if not self.overlay:
+            self.overlay = OverlayRenderer(self.config)
+
+        # (static label, value)
+        lines = [
+            ('', exp_date.strftime('%Y%m%d %H:%M:%S')),
+            ('Exposure ', '{0:0.6f}'.format(self.last_exposure)),
+            ('Gain ', '{0:d}'.format(self.gain_v.value)),
+        ]
+
+        # Add temp if value is set, will be skipped if the temp is exactly 0
+        if self.sensortemp_v.value:
+            lines.append(('Temp ', '{0:0.1f}'.format(self.sensortemp_v.value)))
 
-            logger.info('R mean: %0.2f', r_avg)
-            logger.info('G mean: %0.2f', g_avg)
-            logger.info('B mean: %0.2f', b_avg)
+        self.overlay.render(data_bytes, exp_date, lines)
 
-            # Find the gain of each channel
-            adu = (r_avg + g_avg + b_avg) / 3
+
+    def calculate_histogram(self, data_bytes, data_bayer=None):
+        adu, self.adu_percentiles = self.measure_adu(data_bytes, data_bayer=data_bayer)
 
         if adu <= 0.0:
             # ensure we do not divide by zero
@@ -571,6 +774,121 @@ class ImageProcessWorker(Process):
         return adu, adu_average
 
 
+    def measure_adu(self, data_bytes, data_bayer=None, mode=None):
+        if not mode:
+            mode = self.config.get('ADU_MODE', 'full')
+
+        step = int(self.config.get('ADU_SUBSAMPLE', 4))
+
+        if mode == 'bayer' and self.config['IMAGE_DEBAYER'] and data_bayer is not None:
+            # calibrated mosaic before debayering, every step 2x2 cell
+            scidata = self._adu_roi(data_bayer, even=True)
+
+            # ADU values are always on an 8 bit scale
+            adu_scale = 255.0 / self.max_value(scidata)
+
+            r_pos, g1_pos, g2_pos, b_pos = self._bayer_offsets()
+
+            # [cell_y, row, cell_x, column], whole 2x2 cells so every colour is sampled
+            cell_h = scidata.shape[0] // 2
+            cell_w = scidata.shape[1] // 2
+            cells = scidata[:cell_h * 2, :cell_w * 2].reshape(cell_h, 2, cell_w, 2)[::step, :, ::step, :]
+
+            r_avg = numpy.mean(cells[:, r_pos[0], :, r_pos[1]]) * adu_scale
+            g_avg = (numpy.mean(cells[:, g1_pos[0], :, g1_pos[1]]) + numpy.mean(cells[:, g2_pos[0], :, g2_pos[1]])) * adu_scale / 2
+            b_avg = numpy.mean(cells[:, b_pos[0], :, b_pos[1]]) * adu_scale
+
+            sample = numpy.ascontiguousarray(cells.reshape(-1, 4))  # one cell per row
+        else:
+            scidata = self._adu_roi(data_bytes)
+
+            # ADU values are always on an 8 bit scale
+            adu_scale = 255.0 / self.max_value(scidata)
+
+            if mode == 'subsample':
+                sample = scidata[::step, ::step]
+                channel_avgs = numpy.mean(sample, axis=(0, 1)).reshape(-1)
+            else:
+                sample = scidata
+                channel_avgs = cv2.mean(scidata)  # per channel, no split required
+
+            if not self.config['IMAGE_DEBAYER']:
+                m_avg = channel_avgs[0] * adu_scale
+
+                logger.info('Greyscale mean: %0.2f', m_avg)
+
+                return float(m_avg), self._adu_percentiles(sample, adu_scale)
+
+            r_avg = channel_avgs[0] * adu_scale
+            g_avg = channel_avgs[1] * adu_scale
+            b_avg = channel_avgs[2] * adu_scale
+
+
+        logger.info('R mean: %0.2f', r_avg)
+        logger.info('G mean: %0.2f', g_avg)
+        logger.info('B mean: %0.2f', b_avg)
+
+        # Find the gain of each channel
+        adu = (r_avg + g_avg + b_avg) / 3
+
+        return float(adu), self._adu_percentiles(sample, adu_scale)
+
+
+    def _adu_roi(self, data_bytes, even=False):
+        if not self.config['ADU_ROI']:
+            return data_bytes
+
+        logger.warning('Calculating ADU from RoI')
+        # divide the coordinates by binning value
+        x1 = int(self.config['ADU_ROI'][0] / self.bin_v.value)
+        y1 = int(self.config['ADU_ROI'][1] / self.bin_v.value)
+        x2 = int(self.config['ADU_ROI'][2] / self.bin_v.value)
+        y2 = int(self.config['ADU_ROI'][3] / self.bin_v.value)
+
+        if even:
+            # keep the bayer pattern aligned
+            x1 -= x1 % 2
+            y1 -= y1 % 2
+
+        return data_bytes[
+            y1:(y1 + y2),
+            x1:(x1 + x2),
+        ]
+
+
+    def _bayer_offsets(self):
+        ### (row, column) of the R, G, G, B pixels in each 2x2 cell
+        # OpenCV names the pattern starting from the second row and column
+        pattern = self.config['IMAGE_DEBAYER'].upper().replace('BAYER_', 'BAYER').split('BAYER')[-1][:2]
+
+        return {
+            'BG' : ((0, 0), (0, 1), (1, 0), (1, 1)),
+            'RG' : ((1, 1), (0, 1), (1, 0), (0, 0)),
+            'GR' : ((1, 0), (0, 0), (1, 1), (0, 1)),
+            'GB' : ((0, 1), (0, 0), (1, 1), (1, 0)),
+        }[pattern]
+
+
+    def _adu_percentiles(self, sample, adu_scale):
+        percentiles = self.config.get('ADU_PERCENTILES', [5, 50, 95, 99])
+        if not percentiles:
+            return dict()
+
+        # histogram of all channels
+        bins = self.max_value(sample) + 1
+        channels = 1 if sample.ndim == 2 else sample.shape[2]
+
+        hist = sum([cv2.calcHist([sample], [c], None, [bins], [0, bins]) for c in range(channels)])
+        hist_cumulative = numpy.cumsum(hist.ravel())
+
+        adu_percentiles = dict()
+        for p in percentiles:
+            value = numpy.searchsorted(hist_cumulative, hist_cumulative[-1] * (p / 100.0))
+            adu_percentiles['adu_p{0:d}'.format(int(p))] = float(value) * adu_scale
+
+        return adu_percentiles
+
+
     def recalculate_exposure(self, adu, target_adu_min, target_adu_max, exp_scale_factor):
 
         # Until we reach a good starting point, do not calculate a moving average
@@ -608,16 +926,18 @@ class ImageProcessWorker(Process):
 
     def contrast_clahe(self, data_bytes):
         ### ohhhh, contrasty
-        lab = cv2.cvtColor(data_bytes, cv2.COLOR_RGB2LAB)
+        lab = cv2.cvtColor(data_bytes, cv2.COLOR_RGB2LAB, dst=self.buffer_pool.get('contrast_lab', data_bytes.shape, data_bytes.dtype))
+
+        l = cv2.extractChannel(lab, 0, dst=self.buffer_pool.get('contrast_l', data_bytes.shape[:2], data_bytes.dtype))
 
-        l, a, b = cv2.split(lab)
+        if not self.clahe:
+            self.clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
 
-        clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
-        cl = clahe.apply(l)
+        cl = self.clahe.apply(l, dst=self.buffer_pool.get('contrast_cl', data_bytes.shape[:2], data_bytes.dtype))
 
-        new_lab = cv2.merge((cl, a, b))
+        cv2.insertChannel(cl, lab, 0)  # replace L channel in place
 
-        new_data = cv2.cvtColor(new_lab, cv2.COLOR_LAB2RGB)
+        new_data = cv2.cvtColor(lab, cv2.COLOR_LAB2RGB, dst=self.buffer_pool.get('contrast', data_bytes.shape, data_bytes.dtype))
         return new_data
 
 
@@ -646,84 +966,3 @@ class ImageProcessWorker(Process):
         data_blur = cv2.medianBlur(data_bytes, ksize=3)
         return data_blur
 
-
-    def _convert_GRBG_to_RGB_8bit(self, data_bytes):
-        data_bytes = numpy.frombuffer(data_bytes, dtype=numpy.uint8)
-        even = data_bytes[0::2]
-        odd = data_bytes[1::2]
-        # Convert bayer16 to bayer8
-        bayer8_image = (even >> 4) | (odd << 4)
-        bayer8_image = bayer8_image.reshape((1080, 1920))
-        # Use OpenCV to convert Bayer GRBG to RGB
-        return cv2.cvtColor(bayer8_image, cv2.COLOR_BayerGR2RGB)
-
-
-    def calculateSkyObject(self, skyObj):
-        obs = ephem.Observer()
-        obs.lon = str(self.config['LOCATION_LONGITUDE'])
-        obs.lat = str(self.config['LOCATION_LATITUDE'])
-        obs.date = datetime.utcnow()  # ephem expects UTC dates
-        #obs.date = datetime.utcnow() - timedelta(hours=13)  # testing
-
-        skyObj.compute(obs)
-
-        return obs
-
-
-    def getOrbXY(self, skyObj):
-        obs = self.calculateSkyObject(skyObj)
-
-        ha_rad = obs.sidereal_time() - skyObj.ra
-        ha_deg = math.degrees(ha_rad)
-
-        if ha_deg < -180:
-            ha_deg = 360 + ha_deg
-        elif ha_deg > 180:
-            ha_deg = -360 + ha_deg
-        else:
-            pass
-
-        logger.info('%s hour angle: %0.2f', skyObj.name, ha_deg)
-
-        abs_ha_deg = abs(ha_deg)
-        perimeter_half = self.image_width + self.image_height
-
-        mapped_ha_deg = int(self.remap(abs_ha_deg, 0, 180, 0, perimeter_half))
-        #logger.info('Mapped hour angle: %d', mapped_ha_deg)
-
-        ### The image perimeter is mapped to the hour angle for the X,Y coordinates
-        if mapped_ha_deg < (self.image_width / 2) and ha_deg < 0:
-            #logger.info('Top right')
-            x = (self.image_width / 2) + mapped_ha_deg
-            y = 0
-        elif mapped_ha_deg < (self.image_width / 2) and ha_deg > 0:
-            #logger.info('Top left')
-            x = (self.image_width / 2) - mapped_ha_deg
-            y = 0
-        elif mapped_ha_deg > ((self.image_width / 2) + self.image_height) and ha_deg < 0:
-            #logger.info('Bottom right')
-            x = self.image_width - (mapped_ha_deg - (self.image_height + (self.image_width / 2)))
-            y = self.image_height
-        elif mapped_ha_deg > ((self.image_width / 2) + self.image_height) and ha_deg > 0:
-            #logger.info('Bottom left')
-            x = mapped_ha_deg - (self.image_height + (self.image_width / 2))
-            y = self.image_height
-        elif ha_deg < 0:
-            #logger.info('Right')
-            x = self.image_width
-            y = mapped_ha_deg - (self.image_width / 2)
-        elif ha_deg > 0:
-            #logger.info('Left')
-            x = 0
-            y = mapped_ha_deg - (self.image_width / 2)
-        else:
-            raise Exception('This cannot happen')
-
-
-        #logger.info('Orb: %0.2f x %0.2f', x, y)
-
-        return int(x), int(y)
-
-
-    def remap(self, x, in_min, in_max, out_min, out_max):
-        return (float(x) - float(in_min)) * (float(out_max) - float(out_min)) / (float(in_max) - float(in_min)) + float(out_min)
@@ -1,4 +1,5 @@
 import time
+import threading
 from datetime import datetime
 
 import multiprocessing
@@ -12,18 +13,26 @@ logger = multiprocessing.get_logger()
 
 
 class IndiClient(PyIndi.BaseClient):
-    def __init__(self, config, indiblob_status_send, image_q):
+    def __init__(self, config, indiblob_status_send, image_q, frame_buffer=None):
         super(IndiClient, self).__init__()
 
         self.config = config
         self.indiblob_status_send = indiblob_status_send
         self.image_q = image_q
+        self.frame_buffer = frame_buffer
 
         self._device = None
         self._filename_t = '{0:s}.{1:s}'
 
         self._timeout = 10.0
 
+        self.__state_to_str = { PyIndi.IPS_IDLE: 'IDLE', PyIndi.IPS_OK: 'OK', PyIndi.IPS_BUSY: 'BUSY', PyIndi.IPS_ALERT: 'ALERT' }
+
+        # notified from the INDI callbacks when properties change
+        self._property_cond = threading.Condition()
+        self._property_gen = 0  # incremented on every notification
+        self._max_wait = 1.0  # upper bound between checks in case a notification is missed
+
         logger.info('creating an instance of IndiClient')
 
 
@@ -53,45 +62,64 @@ class IndiClient(PyIndi.BaseClient):
 
     def newDevice(self, d):
         logger.info("new device %s", d.getDeviceName())
+        self._notify()
 
     def newProperty(self, p):
         #logger.info("new property %s for device %s", p.getName(), p.getDeviceName())
-        pass
+        self._notify()
 
     def removeProperty(self, p):
         logger.info("remove property %s for device %s", p.getName(), p.getDeviceName())
+        self._notify()
 
 
     def newBLOB(self, bp):
         logger.info("new BLOB %s", bp.name)
-        start = time.time()
+        start = time.monotonic()
 
         ### get image data
         imgdata = bp.getblobdata()
 
-        elapsed_s = time.time() - start
+        elapsed_s = time.monotonic() - start
         logger.info('Blob downloaded in %0.4f s', elapsed_s)
 
-        self.indiblob_status_send.send(True)  # Notify main process next exposure may begin
-
         exp_date = datetime.now()
 
+        i_dict = { 'exp_date' : exp_date, 'filename_t' : self._filename_t, 'download_s' : elapsed_s }
+
+        frame = None
+        if self.frame_buffer:
+            # blocks while all slots are in use by the image worker
+            frame = self.frame_buffer.put(imgdata, timeout=float(self.config.get('FRAME_BUFFER_TIMEOUT', 5.0)))
+
+        if frame:
+            i_dict.update(frame)
+        else:
+            # fall back to sending the data through the queue
+            i_dict['imgdata'] = imgdata
+
+        self.indiblob_status_send.send(True)  # Notify main process next exposure may begin
+
         ### process data in worker
-        self.image_q.put({ 'imgdata' : imgdata, 'exp_date' : exp_date, 'filename_t' : self._filename_t })
+        i_dict['queued'] = time.monotonic()
+        self.image_q.put(i_dict)
 
 
     def newSwitch(self, svp):
         logger.info("new Switch %s for device %s", svp.name, svp.device)
+        self._notify()
 
     def newNumber(self, nvp):
         #logger.info("new Number %s for device %s", nvp.name, nvp.device)
-        pass
+        self._notify()
 
     def newText(self, tvp):
         logger.info("new Text %s for device %s", tvp.name, tvp.device)
+        self._notify()
 
     def newLight(self, lvp):
         logger.info("new Light %s for device %s", lvp.name, lvp.device)
+        self._notify()
 
     def newMessage(self, d, m):
         logger.info("new Message %s", d.messageQueue(m))
@@ -103,6 +131,40 @@ class IndiClient(PyIndi.BaseClient):
         logger.info("Server disconnected (exit code = %d, %s, %d", code, str(self.getHost()), self.getPort())
 
 
+    def _notify(self):
+        # wake up threads waiting on property changes
+        with self._property_cond:
+            self._property_gen += 1
+            self._property_cond.notify_all()
+
+
+    def _wait_for(self, predicate, timeout):
+        # returns the predicate result, None on timeout
+        # timeout of 0 waits forever
+        started = time.monotonic()
+
+        while True:
+            with self._property_cond:
+                gen = self._property_gen
+
+            # the predicate calls into PyIndi, do not block the callbacks while it runs
+            result = predicate()
+            if result:
+                return result
+
+            if 0 < timeout:
+                remaining = timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    return None
+            else:
+                remaining = self._max_wait
+
+            with self._property_cond:
+                if gen == self._property_gen:
+                    # no change since the predicate was checked
+                    self._property_cond.wait(min(remaining, self._max_wait))
+
+
 
     def get_control(self, name, ctl_type, timeout=None, device=None):
         if not device:
@@ -120,18 +182,35 @@ class IndiClient(PyIndi.BaseClient):
             'blob'    : 'getBLOB'
         }[ctl_type]
 
-        started = time.time()
-        while not(ctl):
-            ctl = getattr(device, attr)(name)
+        ctl = self._wait_for(lambda: getattr(device, attr)(name), timeout)
 
-            if not ctl and 0 < timeout < time.time() - started:
-                raise TimeOutException('Timeout finding control {0}'.format(name))
-
-            time.sleep(0.01)
+        if not ctl:
+            raise TimeOutException('Timeout finding control {0}'.format(name))
 
         return ctl
 
 
+    def wait_for_device(self, name, timeout=None):
+        if timeout is None:
+            timeout = self._timeout
+
+        device = self._wait_for(lambda: self.getDevice(name), timeout)
+
+        if not device:
+            raise TimeOutException('Timeout waiting for device {0}'.format(name))
+
+        return device
+
+
+    def wait_for_connection(self, device, timeout=None):
+        if timeout is None:
+            timeout = self._timeout
+
+        # CONNECTION switch updates wake the wait
+        if not self._wait_for(lambda: device.isConnected(), timeout):
+            raise TimeOutException('Timeout connecting to device {0}'.format(device.getDeviceName()))
+
+
     def set_controls(self, controls, device=None):
         if not device:
             device = self._device
@@ -180,6 +259,11 @@ class IndiClient(PyIndi.BaseClient):
 
         self.sendNewSwitch(c)
 
+        if sync:
+            self.__wait_for_ctl_statuses(c, timeout=timeout)
+
+        return c
+
 
     def set_text(self, control_name, values, sync=True, timeout=None, device=None):
         if not device:
@@ -218,21 +302,20 @@ class IndiClient(PyIndi.BaseClient):
 
 
     def __wait_for_ctl_statuses(self, ctl, statuses=[PyIndi.IPS_OK, PyIndi.IPS_IDLE], timeout=None):
-        started = time.time()
+        started = time.monotonic()
         if timeout is None:
             timeout = self._timeout
 
-        while ctl.getState() not in statuses:
+        def ctl_ready():
             #logger.info('%s/%s/%s: %s', ctl.getDeviceName(), ctl.getGroupName(), ctl.getName(), self.__state_to_str[ctl.getState()])
-            if ctl.getState() == PyIndi.IPS_ALERT and 0.5 > time.time() - started:
+            if ctl.getState() == PyIndi.IPS_ALERT and 0.5 > time.monotonic() - started:
                 raise RuntimeError('Error while changing property {0}'.format(ctl.getName()))
 
-            elapsed = time.time() - started
-
-            if 0 < timeout < elapsed:
-                raise TimeOutException('Timeout error while changing property {0}: elapsed={1}, timeout={2}, status={3}'.format(ctl.getName(), elapsed, timeout, self.__state_to_str[ctl.getState()] ))
+            return ctl.getState() in statuses
 
-            time.sleep(0.05)
+        if not self._wait_for(ctl_ready, timeout):
+            elapsed = time.monotonic() - started
+            raise TimeOutException('Timeout error while changing property {0}: elapsed={1}, timeout={2}, status={3}'.format(ctl.getName(), elapsed, timeout, self.__state_to_str[ctl.getState()] ))
 
 
     def __map_indexes(self, ctl, values):
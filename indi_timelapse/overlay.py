@@ -0,0 +1,309 @@
+import math
+from datetime import datetime
+from datetime import timezone
+
+import multiprocessing
+
+import ephem
+import cv2
+import numpy
+
+
+logger = multiprocessing.get_logger()
+
+
+class OverlayRenderer(object):
+    ### Text and orbs drawn on every image
+    # Text is rendered once into small patches with an alpha mask and composited onto the image.
+    # Labels are static, values are only rendered again when they change.
+
+    def __init__(self, config):
+        self.config = config
+
+        text_props = self.config['TEXT_PROPERTIES']
+        orb_props = self.config['ORB_PROPERTIES']
+
+        self.font_face = getattr(cv2, text_props['FONT_FACE'])
+        self.line_type = getattr(cv2, text_props['FONT_AA'])
+        self.font_scale = text_props['FONT_SCALE']
+        self.font_thickness = text_props['FONT_THICKNESS']
+        self.font_color = tuple(text_props['FONT_COLOR'])
+        self.font_outline = text_props['FONT_OUTLINE']
+        self.font_x = text_props['FONT_X']
+        self.font_y = text_props['FONT_Y']
+        self.font_height = text_props['FONT_HEIGHT']
+
+        self.orb_radius = orb_props['RADIUS']
+        self.sun_color = tuple(orb_props['SUN_COLOR'])
+        self.moon_color = tuple(orb_props['MOON_COLOR'])
+
+        # padding around the text for the outline and anti-aliasing
+        self.text_pad = self.font_thickness + 2
+
+        self.orb_positions = OrbPositions(
+            self.config['LOCATION_LONGITUDE'],
+            self.config['LOCATION_LATITUDE'],
+        )
+
+        self._label_patches = dict()  # (label, dtype, channels) => patch
+        self._value_patches = dict()  # (line, dtype, channels) => (value, patch)
+
+
+    def render(self, img, exp_date, lines):
+        image_height, image_width = img.shape[:2]
+
+        # colors are 8 bit values
+        color_scale = 257 if img.dtype == numpy.uint16 else 1
+
+        sun_ha_deg = self.orb_positions.hour_angle('Sun', exp_date)
+        sunOrbX, sunOrbY = self.getOrbXY(sun_ha_deg, image_width, image_height)
+        self.drawOrb(img, (sunOrbX, sunOrbY), [c * color_scale for c in self.sun_color])
+
+        moon_ha_deg = self.orb_positions.hour_angle('Moon', exp_date)
+        moonOrbX, moonOrbY = self.getOrbXY(moon_ha_deg, image_width, image_height)
+        self.drawOrb(img, (moonOrbX, moonOrbY), [c * color_scale for c in self.moon_color])
+
+        logger.info('Sun hour angle: %0.2f', sun_ha_deg)
+        logger.info('Moon hour angle: %0.2f', moon_ha_deg)
+
+
+        for i, (label, value) in enumerate(lines):
+            x = self.font_x
+            y = self.font_y + (self.font_height * i)  # baseline
+
+            if label:
+                label_key = (label, img.dtype, self._channels(img))
+
+                label_patch = self._label_patches.get(label_key)
+                if not label_patch:
+                    label_patch = self._renderText(label, img)
+                    self._label_patches[label_key] = label_patch
+
+                self._composite(img, label_patch, x, y)
+                x += label_patch['advance']
+
+
+            value_key = (i, img.dtype, self._channels(img))
+
+            cached_value, value_patch = self._value_patches.get(value_key, (None, None))
+            if cached_value != value:
+                value_patch = self._renderText(value, img)
+                self._value_patches[value_key] = (value, value_patch)
+
+            self._composite(img, value_patch, x, y)
+
+
+    def drawOrb(self, img, center, color):
+        # outline
+        cv2.circle(
+            img=img,
+            center=center,
+            radius=self.orb_radius,
+            color=(0, 0, 0),
+            thickness=cv2.FILLED,
+        )
+        cv2.circle(
+            img=img,
+            center=center,
+            radius=self.orb_radius - 1,
+            color=color,
+            thickness=cv2.FILLED,
+        )
+
+
+    def _channels(self, img):
+        if img.ndim == 2:
+            return 1
+
+        return img.shape[2]
+
+
+    def _renderText(self, text, img):
+        thickness = self.font_thickness
+        if self.font_outline:
+            thickness += 1
+
+        (text_width, text_height), baseline = cv2.getTextSize(text, self.font_face, self.font_scale, thickness)
+
+        org = (self.text_pad, self.text_pad + text_height)
+
+        patch_8bit = numpy.zeros((text_height + baseline + (self.text_pad * 2), text_width + (self.text_pad * 2), 3), dtype=numpy.uint8)
+        alpha_8bit = numpy.zeros(patch_8bit.shape[:2], dtype=numpy.uint8)
+
+        if self.font_outline:
+            for layer, color in ((patch_8bit, (0, 0, 0)), (alpha_8bit, 255)):
+                cv2.putText(
+                    img=layer,
+                    text=text,
+                    org=org,
+                    fontFace=self.font_face,
+                    color=color,
+                    lineType=self.line_type,
+                    fontScale=self.font_scale,
+                    thickness=self.font_thickness + 1,
+                )  # black outline
+
+        for layer, color in ((patch_8bit, self.font_color), (alpha_8bit, 255)):
+            cv2.putText(
+                img=layer,
+                text=text,
+                org=org,
+                fontFace=self.font_face,
+                color=color,
+                lineType=self.line_type,
+                fontScale=self.font_scale,
+                thickness=self.font_thickness,
+            )
+
+
+        if self._channels(img) == 1:
+            # mono images use the first color value, like putText
+            patch_8bit = patch_8bit[:, :, 0]
+
+        alpha = alpha_8bit.astype(numpy.float32) / 255
+        if patch_8bit.ndim == 3:
+            alpha = alpha[:, :, numpy.newaxis]
+
+        if img.dtype == numpy.uint16:
+            patch = patch_8bit.astype(numpy.float32) * 257
+        else:
+            patch = patch_8bit.astype(numpy.float32)
+
+        return {
+            'premultiplied' : patch * alpha,
+            'inv_alpha'     : 1.0 - alpha,
+            'org'           : org,
+            'advance'       : cv2.getTextSize(text, self.font_face, self.font_scale, self.font_thickness)[0][0],
+        }
+
+
+    def _composite(self, img, patch, x, y):
+        image_height, image_width = img.shape[:2]
+        patch_height, patch_width = patch['inv_alpha'].shape[:2]
+
+        # top left of the patch in image coordinates
+        x1 = x - patch['org'][0]
+        y1 = y - patch['org'][1]
+
+        # clip to the image
+        px1 = max(0, -x1)
+        py1 = max(0, -y1)
+        px2 = min(patch_width, image_width - x1)
+        py2 = min(patch_height, image_height - y1)
+
+        if px1 >= px2 or py1 >= py2:
+            return
+
+        roi = img[y1 + py1:y1 + py2, x1 + px1:x1 + px2]
+
+        blended = (roi * patch['inv_alpha'][py1:py2, px1:px2]) + patch['premultiplied'][py1:py2, px1:px2]
+        roi[:] = blended
+
+
+    def getOrbXY(self, ha_deg, image_width, image_height):
+        abs_ha_deg = abs(ha_deg)
+        perimeter_half = image_width + image_height
+
+        mapped_ha_deg = int(self.remap(abs_ha_deg, 0, 180, 0, perimeter_half))
+        #logger.info('Mapped hour angle: %d', mapped_ha_deg)
+
+        ### The image perimeter is mapped to the hour angle for the X,Y coordinates
+        if mapped_ha_deg < (image_width / 2) and ha_deg < 0:
+            #logger.info('Top right')
+            x = (image_width / 2) + mapped_ha_deg
+            y = 0
+        elif mapped_ha_deg < (image_width / 2) and ha_deg > 0:
+            #logger.info('Top left')
+            x = (image_width / 2) - mapped_ha_deg
+            y = 0
+        elif mapped_ha_deg > ((image_width / 2) + image_height) and ha_deg < 0:
+            #logger.info('Bottom right')
+            x = image_width - (mapped_ha_deg - (image_height + (image_width / 2)))
+            y = image_height
+        elif mapped_ha_deg > ((image_width / 2) + image_height) and ha_deg > 0:
+            #logger.info('Bottom left')
+            x = mapped_ha_deg - (image_height + (image_width / 2))
+            y = image_height
+        elif ha_deg < 0:
+            #logger.info('Right')
+            x = image_width
+            y = mapped_ha_deg - (image_width / 2)
+        elif ha_deg > 0:
+            #logger.info('Left')
+            x = 0
+            y = mapped_ha_deg - (image_width / 2)
+        else:
+            # exactly 0 degrees
+            x = image_width / 2
+            y = 0
+
+
+        #logger.info('Orb: %0.2f x %0.2f', x, y)
+
+        return int(x), int(y)
+
+
+    def remap(self, x, in_min, in_max, out_min, out_max):
+        return (float(x) - float(in_min)) * (float(out_max) - float(out_min)) / (float(in_max) - float(in_min)) + float(out_min)
+
+
+
+class OrbPositions(object):
+    ### Hour angles are calculated on a fixed interval and interpolated in between
+    # The sun and moon hour angles change almost linearly over a few minutes
+
+    def __init__(self, longitude, latitude, interval=600):
+        self.interval = int(interval)
+
+        self.obs = ephem.Observer()
+        self.obs.lon = str(longitude)
+        self.obs.lat = str(latitude)
+
+        self._samples = dict()  # (body, slot) => hour angle
+
+
+    def hour_angle(self, body_name, exp_date):
+        t = exp_date.timestamp()
+
+        slot = int(t // self.interval)
+        ha_deg_1 = self._sample(body_name, slot)
+        ha_deg_2 = self._sample(body_name, slot + 1)
+
+        # shortest distance across the -180/180 wrap
+        delta_deg = ((ha_deg_2 - ha_deg_1 + 180) % 360) - 180
+        ha_deg = ha_deg_1 + (delta_deg * ((t - (slot * self.interval)) / self.interval))
+
+        return self._normalize(ha_deg)
+
+
+    def _sample(self, body_name, slot):
+        key = (body_name, slot)
+
+        ha_deg = self._samples.get(key)
+        if ha_deg is not None:
+            return ha_deg
+
+
+        # remove samples from previous intervals
+        for old_key in [k for k in self._samples.keys() if k[1] < slot - 1]:
+            del self._samples[old_key]
+
+
+        self.obs.date = datetime.fromtimestamp(slot * self.interval, tz=timezone.utc).replace(tzinfo=None)  # ephem expects UTC dates
+
+        body = getattr(ephem, body_name)()
+        body.compute(self.obs)
+
+        ha_deg = self._normalize(math.degrees(self.obs.sidereal_time() - body.ra))
+        self._samples[key] = ha_deg
+
+        return ha_deg
+
+
+    def _normalize(self, ha_deg):
+        if ha_deg < -180:
+            ha_deg = 360 + ha_deg
+        elif ha_deg > 180:
+            ha_deg = -360 + ha_deg
+
+        return ha_deg
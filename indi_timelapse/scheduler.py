@@ -0,0 +1,69 @@
+import time
+
+import multiprocessing
+
+
+logger = multiprocessing.get_logger()
+
+
+class ExposureScheduler(object):
+    ### Exposure start times are planned on a fixed grid using the monotonic clock
+    # Late exposures start immediately, the grid is only moved forward when whole slots are missed
+
+    def __init__(self, period):
+        self._period = float(period)
+
+        self.next_slot = None
+        self.slot_count = 0
+        self.missed_slots = 0
+
+
+    @property
+    def period(self):
+        return self._period
+
+    @period.setter
+    def period(self, new_period):
+        new_period = float(new_period)
+
+        if new_period == self._period:
+            return
+
+        logger.info('Exposure period changed to %0.4f s', new_period)
+        self._period = new_period
+        self.reset()
+
+
+    def reset(self):
+        # grid starts again with the next exposure
+        self.next_slot = None
+
+
+    def wait(self):
+        now = time.monotonic()
+
+        if self.next_slot is None:
+            self.next_slot = now
+
+        late_s = now - self.next_slot
+
+        if late_s >= self._period:
+            missed = int(late_s // self._period)
+
+            self.missed_slots += missed
+            logger.warning('Missed %d exposure slot(s), %0.4f s behind schedule (%d missed total)', missed, late_s, self.missed_slots)
+
+            self.next_slot += missed * self._period
+        elif late_s > 0:
+            logger.info('Exposure starting %0.4f s late', late_s)
+        else:
+            logger.info('Sleeping for %0.4f s until next exposure', -late_s)
+            time.sleep(-late_s)
+
+
+        slot_start = self.next_slot
+
+        self.next_slot += self._period
+        self.slot_count += 1
+
+        return slot_start
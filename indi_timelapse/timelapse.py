@@ -8,6 +8,7 @@ from datetime import timedelta
 import copy
 import math
 import signal
+import queue
 
 import ephem
 
@@ -22,11 +23,18 @@ from .indi import IndiClient
 from .image import ImageProcessWorker
 from .video import VideoProcessWorker
 from .uploader import FileUploader
+from .httpserver import LatestFrameServer
+from .framebuffer import FrameRingBuffer
+from .scheduler import ExposureScheduler
+from .catalog import ImageCatalog
 from .exceptions import TimeOutException
 
 logger = multiprocessing.get_logger()
 
 
+IMAGE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'tif', 'tiff']
+
+
 class IndiTimelapse(object):
 
     def __init__(self, f_config_file):
@@ -36,6 +44,7 @@ class IndiTimelapse(object):
         self.config_file = f_config_file.name
 
         self.image_q = Queue()
+        self.frame_buffer = None
         self.indiblob_status_receive, self.indiblob_status_send = Pipe(duplex=False)
         self.indiclient = None
         self.device = None
@@ -47,19 +56,31 @@ class IndiTimelapse(object):
 
         self.night_sun_radians = math.radians(float(self.config['NIGHT_SUN_ALT_DEG']))
 
+        self.scheduler = ExposureScheduler(self.config['EXPOSURE_PERIOD'])
+        self.slot_count_v = Value('i', 0)
+        self.missed_slots_v = Value('i', 0)
+
         self.image_worker = None
         self.image_worker_idx = 0
 
         self.video_worker = None
         self.video_q = Queue()
         self.video_worker_idx = 0
+        self.segment_hour = None
 
         self.save_fits = False
         self.save_images = True
+        self.compress_fits = True
 
         self.upload_worker = None
         self.upload_q = Queue()
         self.upload_worker_idx = 0
+        self.upload_elapsed_v = Value('f', 0)
+        self.upload_count_v = Value('i', 0)
+
+        self.http_worker = None
+        self.http_frame_q = None
+        self.http_worker_idx = 0
 
 
         self.__state_to_str = { PyIndi.IPS_IDLE: 'IDLE', PyIndi.IPS_OK: 'OK', PyIndi.IPS_BUSY: 'BUSY', PyIndi.IPS_ALERT: 'ALERT' }
@@ -70,8 +91,8 @@ class IndiTimelapse(object):
 
         self.generate_timelapse_flag = False   # This is updated once images have been generated
 
-        signal.signal(signal.SIGALRM, self.alarm_handler)
         signal.signal(signal.SIGHUP, self.hup_handler)
+        signal.signal(signal.SIGTERM, self.term_handler)
 
 
 
@@ -100,18 +121,24 @@ class IndiTimelapse(object):
         self._stopImageProcessWorker()
         self._stopVideoProcessWorker()
         self._stopImageUploadWorker()
+        self._stopHttpWorker()
 
         # Restart worker with new config
+        self._startHttpWorker()
         self._startImageProcessWorker()
         self._startVideoProcessWorker()
         self._startImageUploadWorker()
 
 
-    def alarm_handler(self, signum, frame):
-        raise TimeOutException()
+    def term_handler(self, signum, frame):
+        logger.warning('Caught TERM signal, shutting down')
+        sys.exit(0)  # cleanup runs in finally blocks
 
 
     def _initialize(self):
+        self._startFrameBuffer()
+
+        self._startHttpWorker()
         self._startImageProcessWorker()
         self._startVideoProcessWorker()
         self._startImageUploadWorker()
@@ -121,11 +148,15 @@ class IndiTimelapse(object):
             self.config,
             self.indiblob_status_send,
             self.image_q,
+            frame_buffer=self.frame_buffer,
         )
 
         # set roi
         #indiclient.roi = (270, 200, 700, 700) # region of interest for my allsky cam
 
+        # waits for properties to be defined and changed
+        self.indiclient.timeout = self.config.get('INDI_PROPERTY_TIMEOUT', 10.0)
+
         # set indi server localhost and port 7624
         self.indiclient.setServer("localhost", 7624)
 
@@ -136,21 +167,35 @@ class IndiTimelapse(object):
             logger.error("  indiserver indi_simulator_telescope indi_simulator_ccd")
             sys.exit(1)
 
-        # give devices a chance to register
-        time.sleep(8)
+        device_timeout = float(self.config.get('INDI_DEVICE_TIMEOUT', 10.0))
 
-        # connect to all devices
-        for d in self.indiclient.getDevices():
-            logger.info('Found device %s', d.getDeviceName())
+        # wait for the device to register
+        try:
+            self.device = self.indiclient.wait_for_device(self.config['CCD_NAME'], timeout=device_timeout)
+        except TimeOutException as e:
+            logger.error('%s', str(e))
 
-            if d.getDeviceName() == self.config['CCD_NAME']:
-                logger.info('Connecting to device %s', d.getDeviceName())
-                self.indiclient.connectDevice(d.getDeviceName())
-                self.device = d
+            for d in self.indiclient.getDevices():
+                logger.error('Found device %s', d.getDeviceName())
+
+            sys.exit(1)
+
+
+        logger.info('Connecting to device %s', self.device.getDeviceName())
+        self.indiclient.connectDevice(self.device.getDeviceName())
+
+        try:
+            self.indiclient.wait_for_connection(self.device, timeout=device_timeout)
+        except TimeOutException as e:
+            logger.error('%s', str(e))
+            sys.exit(1)
 
         # set default device in indiclient
         self.indiclient.device = self.device
 
+        # wait for the exposure property to be defined
+        self.indiclient.get_control('CCD_EXPOSURE', 'number')
+
         # set BLOB mode to BLOB_ALSO
         logger.info('Set BLOB mode')
         self.indiclient.setBLOBMode(1, self.device.getDeviceName(), None)
@@ -168,6 +213,11 @@ class IndiTimelapse(object):
             if self.image_worker.is_alive():
                 return
 
+            if self.frame_buffer and self.image_worker.exitcode != 0:
+                # slots held by the failed worker are never returned
+                self._drainImageQueue()
+                self._replaceFrameBuffer()
+
         self.image_worker_idx += 1
 
         logger.info('Starting ImageProcessorWorker process')
@@ -183,6 +233,13 @@ class IndiTimelapse(object):
             self.night_v,
             save_fits=self.save_fits,
             save_images=self.save_images,
+            compress_fits=self.compress_fits,
+            frame_buffer=self.frame_buffer,
+            upload_elapsed_v=self.upload_elapsed_v,
+            upload_count_v=self.upload_count_v,
+            slot_count_v=self.slot_count_v,
+            missed_slots_v=self.missed_slots_v,
+            http_frame_q=self.http_frame_q,
         )
         self.image_worker.start()
 
@@ -197,6 +254,73 @@ class IndiTimelapse(object):
         self.image_worker.join()
 
 
+    def _drainImageQueue(self):
+        ### Frames in the frame buffer are dropped, frames with data in the message are kept
+        keep_list = list()
+        dropped = 0
+
+        while True:
+            try:
+                i_dict = self.image_q.get_nowait()
+            except queue.Empty:
+                break
+
+            if i_dict.get('stop'):
+                # sent to the failed worker
+                continue
+
+            if i_dict.get('slot') is not None:
+                dropped += 1
+                continue
+
+            keep_list.append(i_dict)
+
+        for i_dict in keep_list:
+            self.image_q.put(i_dict)
+
+        if dropped:
+            logger.warning('Dropped %d queued frames from the frame buffer', dropped)
+
+
+    def _replaceFrameBuffer(self):
+        ### Slots may still be held by the INDI client, the old buffer is abandoned instead of reused
+        # frames written to the old buffer are dropped by the image worker
+        old_frame_buffer = self.frame_buffer
+
+        self.frame_buffer = None
+        self._startFrameBuffer()
+
+        if self.indiclient:
+            self.indiclient.frame_buffer = self.frame_buffer
+
+        # memory is freed when the last mapping is closed
+        old_frame_buffer.unlink()
+
+
+    def _startFrameBuffer(self):
+        if self.frame_buffer:
+            return
+
+        slots = int(self.config.get('FRAME_BUFFER_SLOTS', 3))
+        if not slots:
+            logger.warning('Shared memory frame buffer disabled')
+            return
+
+        self.frame_buffer = FrameRingBuffer(
+            slots,
+            int(self.config.get('FRAME_BUFFER_SLOT_MB', 48)) * 1048576,
+        )
+
+
+    def _stopFrameBuffer(self):
+        if not self.frame_buffer:
+            return
+
+        self.frame_buffer.close()
+        self.frame_buffer.unlink()
+        self.frame_buffer = None
+
+
     def _startVideoProcessWorker(self):
         if self.video_worker:
             if self.video_worker.is_alive():
@@ -209,6 +333,7 @@ class IndiTimelapse(object):
             self.video_worker_idx,
             self.config,
             self.video_q,
+            upload_q=self.upload_q,
         )
         self.video_worker.start()
 
@@ -235,21 +360,59 @@ class IndiTimelapse(object):
             self.upload_worker_idx,
             self.config,
             self.upload_q,
+            upload_elapsed_v=self.upload_elapsed_v,
+            upload_count_v=self.upload_count_v,
         )
 
         self.upload_worker.start()
 
 
-    def _stopImageUploadWorker(self):
+    def _stopImageUploadWorker(self, drain=False):
         if self.upload_worker:
             if not self.upload_worker.is_alive():
                 return
 
         logger.info('Stopping ImageUploadWorker process')
-        self.upload_q.put({ 'stop' : True })
+        self.upload_q.put({ 'stop' : True, 'drain' : drain })  # drain finishes pending uploads
         self.upload_worker.join()
 
 
+    def _startHttpWorker(self):
+        if self.http_worker:
+            if self.http_worker.is_alive():
+                return
+
+        if not self.config.get('HTTP_SERVER', {}).get('ENABLE'):
+            self.http_frame_q = None
+            return
+
+        if not self.http_frame_q:
+            self.http_frame_q = Queue(maxsize=5)
+
+        self.http_worker_idx += 1
+
+        logger.info('Starting LatestFrameServer process %d', self.http_worker_idx)
+        self.http_worker = LatestFrameServer(
+            self.http_worker_idx,
+            self.config,
+            self.http_frame_q,
+        )
+
+        self.http_worker.start()
+
+
+    def _stopHttpWorker(self):
+        if not self.http_worker:
+            return
+
+        if self.http_worker.is_alive():
+            logger.info('Stopping LatestFrameServer process')
+            self.http_frame_q.put({ 'stop' : True })
+            self.http_worker.join()
+
+        self.http_worker = None
+
+
     def _configureCcd(self, indi_config):
         ### Configure CCD Properties
         for k, v in indi_config['PROPERTIES'].items():
@@ -260,7 +423,12 @@ class IndiTimelapse(object):
         ### Configure CCD Switches
         for k, v in indi_config['SWITCHES'].items():
             logger.info('Setting switch %s', k)
-            self.indiclient.set_switch(k, on_switches=v['on'], off_switches=v.get('off', []))
+
+            try:
+                self.indiclient.set_switch(k, on_switches=v['on'], off_switches=v.get('off', []))
+            except (TimeOutException, RuntimeError) as e:
+                # a slow or rejected switch is not fatal
+                logger.error('Unable to set switch %s: %s', k, str(e))
 
         ### Configure controls
         #self.indiclient.set_controls(indi_config.get('CONTROLS', {}))
@@ -277,11 +445,16 @@ class IndiTimelapse(object):
         logger.info('Gain set to %d', self.gain_v.value)
         logger.info('Binning set to %d', self.bin_v.value)
 
-        # Sleep after configuration
-        time.sleep(1.0)
-
 
     def run(self):
+        try:
+            self._run()
+        finally:
+            # shared memory outlives the process unless it is unlinked
+            self._stopFrameBuffer()
+
+
+    def _run(self):
 
         self._initialize()
 
@@ -297,6 +470,9 @@ class IndiTimelapse(object):
             if not self.upload_worker.is_alive():
                 self._startImageUploadWorker()
 
+            if self.http_worker and not self.http_worker.is_alive():
+                self._startHttpWorker()
+
 
             nighttime = self.is_night()
             #logger.info('self.night_v.value: %r', self.night_v.value)
@@ -305,6 +481,7 @@ class IndiTimelapse(object):
             if not nighttime and not self.config['DAYTIME_CAPTURE']:
                 logger.info('Daytime capture is disabled')
                 time.sleep(60)
+                self.scheduler.reset()
                 continue
 
             temp = self.device.getNumber("CCD_TEMPERATURE")
@@ -333,22 +510,43 @@ class IndiTimelapse(object):
                     self._generateDayTimelapse(timespec)
 
 
+            if self.config.get('FFMPEG_SEGMENTS'):
+                self._generateSegments(nighttime)
+
+
+            if nighttime:
+                self.scheduler.period = self.config['EXPOSURE_PERIOD']
+            else:
+                self.scheduler.period = self.config.get('EXPOSURE_PERIOD_DAY', self.config['EXPOSURE_PERIOD'])
+
+
+            # wait for the next slot, late exposures start immediately
+            self.scheduler.wait()
+
+            # scheduler stats are published by the image worker
+            with self.slot_count_v.get_lock():
+                self.slot_count_v.value = self.scheduler.slot_count
+                self.missed_slots_v.value = self.scheduler.missed_slots
+
+            # discard notifications from exposures that timed out
+            while self.indiblob_status_receive.poll():
+                self.indiblob_status_receive.recv()
 
-            start = time.time()
+
+            exposure = self.exposure_v.value
+
+            start = time.monotonic()
 
             try:
-                self.shoot(self.exposure_v.value)
+                self.shoot(exposure, sync=False)
             except TimeOutException as e:
                 logger.error('Timeout: %s', str(e))
                 time.sleep(5.0)
                 continue
 
-            shoot_elapsed_s = time.time() - start
+            shoot_elapsed_s = time.monotonic() - start
             logger.info('shoot() completed in %0.4f s', shoot_elapsed_s)
 
-            # should take far less than 5 seconds here
-            signal.alarm(5)
-
 
             if nighttime:
                 # always indicate timelapse generation at night
@@ -357,25 +555,17 @@ class IndiTimelapse(object):
                 # must be day time
                 self.generate_timelapse_flag = True  # indicate images have been generated for timelapse
 
-            try:
-                self.indiblob_status_receive.recv()  # wait until image is received
-            except TimeOutException:
+            # wait until image is received, the next exposure may begin immediately
+            if not self.indiblob_status_receive.poll((exposure * 2.0) + 5.0):
                 logger.error('Timeout waiting on exposure, continuing')
-                time.sleep(5.0)
                 continue
 
-            signal.alarm(0)  # reset timeout
+            self.indiblob_status_receive.recv()
 
 
-            full_elapsed_s = time.time() - start
+            full_elapsed_s = time.monotonic() - start
             logger.info('Exposure received in %0.4f s', full_elapsed_s)
 
-            # sleep for the remaining eposure period
-            remaining_s = float(self.config['EXPOSURE_PERIOD']) - full_elapsed_s
-            if remaining_s > 0:
-                logger.info('Sleeping for additional %0.4f s', remaining_s)
-                time.sleep(remaining_s)
-
 
     def dayNightReconfigure(self, nighttime):
         logger.warning('Change between night and day')
@@ -391,9 +581,6 @@ class IndiTimelapse(object):
                 self.config['INDI_CONFIG_DAY'],
             )
 
-        # Sleep after reconfiguration
-        time.sleep(1.0)
-
 
     def is_night(self):
         obs = ephem.Observer()
@@ -413,6 +600,7 @@ class IndiTimelapse(object):
 
         self.save_fits = True
         self.save_images = False
+        self.compress_fits = False  # darks are loaded by the dark library
 
         self._initialize()
 
@@ -470,25 +658,36 @@ class IndiTimelapse(object):
         self._stopImageProcessWorker()
         self._stopVideoProcessWorker()
         self._stopImageUploadWorker()
+        self._stopHttpWorker()
 
 
         ### INDI disconnect
         self.indiclient.disconnectServer()
 
+        self._stopFrameBuffer()
+
 
     def generateAllTimelapse(self, timespec, day=True, night=True):
+        self._startVideoProcessWorker()
+
         if day:
             self._generateDayTimelapse(timespec)
 
         if night:
             self._generateNightTimelapse(timespec)
 
+        self._stopVideoProcessWorker()
+
+        self._uploadVideos()
+
 
     def generateDayTimelapse(self, timespec):
         self._startVideoProcessWorker()
         self._generateDayTimelapse(timespec)
         self._stopVideoProcessWorker()
 
+        self._uploadVideos()
+
 
     def _generateDayTimelapse(self, timespec):
         if self.image_worker:
@@ -512,6 +711,17 @@ class IndiTimelapse(object):
         self._generateNightTimelapse(timespec)
         self._stopVideoProcessWorker()
 
+        self._uploadVideos()
+
+
+    def _uploadVideos(self):
+        if not self.config['FILETRANSFER']['UPLOAD_VIDEO']:
+            return
+
+        # upload worker is not running outside of the main loop
+        self._startImageUploadWorker()
+        self._stopImageUploadWorker(drain=True)
+
 
     def _generateNightTimelapse(self, timespec):
         if self.image_worker:
@@ -528,6 +738,35 @@ class IndiTimelapse(object):
         self.video_q.put({ 'timespec' : timespec, 'img_folder' : img_day_folder })
 
 
+    def _generateSegments(self, nighttime):
+        ### Queue completed hours for encoding when the hour changes
+        if not nighttime and not self.config['DAYTIME_TIMELAPSE']:
+            return
+
+        now = datetime.now()
+
+        hour_str = now.strftime('%d_%H')
+        if hour_str == self.segment_hour:
+            return
+
+        self.segment_hour = hour_str
+
+
+        # same layout as ImageProcessWorker.getImageFolder()
+        if nighttime:
+            day_ref = now - timedelta(hours=12)
+            timeofday_str = 'night'
+        else:
+            day_ref = now
+            timeofday_str = 'day'
+
+        timespec = day_ref.strftime('%Y%m%d')
+        img_folder = self.base_dir.joinpath('images', '{0:s}'.format(timespec), timeofday_str)
+
+        logger.info('Generating timelapse segments for %s', img_folder)
+        self.video_q.put({ 'segments' : True, 'timespec' : timespec, 'img_folder' : img_folder, 'exclude_folder' : hour_str })
+
+
     def shoot(self, exposure, sync=True, timeout=None):
         if not timeout:
             timeout = (exposure * 2.0) + 5.0
@@ -556,19 +795,46 @@ class IndiTimelapse(object):
                 logger.error('Cannot remove symlink: %s', str(e))
 
         # Old image files need to be pruned
-        file_list = list()
-        self.getFolderFilesByExt(img_root_folder, file_list, extension_list=['jpg', 'jpeg', 'png', 'tif', 'tiff'])
-
         cutoff_age = datetime.now() - timedelta(days=days)
 
-        old_files = filter(lambda p: p.stat().st_mtime < cutoff_age.timestamp(), file_list)
+        catalog = self._getCatalog()
+        if catalog:
+            # catalog entries are selected by exposure time
+            old_files = catalog.getImages(before=cutoff_age)
+
+            # files missing from the catalog are found in the old day folders
+            file_list = list()
+            for day_folder in img_root_folder.iterdir():
+                if not day_folder.is_dir() or day_folder.name >= cutoff_age.strftime('%Y%m%d'):
+                    continue
+
+                self.getFolderFilesByExt(day_folder, file_list, extension_list=IMAGE_EXTENSIONS)
+
+            old_file_set = set(old_files)
+            old_files.extend(p for p in file_list if p not in old_file_set and p.stat().st_mtime < cutoff_age.timestamp())
+        else:
+            file_list = list()
+            self.getFolderFilesByExt(img_root_folder, file_list, extension_list=IMAGE_EXTENSIONS)
+
+            old_files = filter(lambda p: p.stat().st_mtime < cutoff_age.timestamp(), file_list)
+
+        removed_list = list()
         for f in old_files:
             logger.info('Removing old image: %s', f)
 
             try:
                 f.unlink()
+            except FileNotFoundError:
+                pass
             except OSError as e:
                 logger.error('Cannot remove file: %s', str(e))
+                continue
+
+            removed_list.append(f)
+
+        if catalog:
+            catalog.removeImages(removed_list)
+            catalog.close()
 
 
         # Remove empty folders
@@ -585,6 +851,35 @@ class IndiTimelapse(object):
                 logger.error('Cannot remove folder: %s', str(e))
 
 
+    def _getCatalog(self):
+        if not self.config.get('IMAGE_CATALOG', True):
+            return None
+
+        return ImageCatalog(self.base_dir.joinpath('catalog.sqlite'), self.base_dir)
+
+
+    def catalogRebuild(self):
+        ### Add image files missing from the catalog and remove entries for deleted files
+        catalog = ImageCatalog(self.base_dir.joinpath('catalog.sqlite'), self.base_dir)
+        catalog.check(self.base_dir.joinpath('images'), IMAGE_EXTENSIONS, fix=True)
+        catalog.close()
+
+
+    def catalogCheck(self):
+        catalog = ImageCatalog(self.base_dir.joinpath('catalog.sqlite'), self.base_dir)
+        missing_list, untracked_list = catalog.check(self.base_dir.joinpath('images'), IMAGE_EXTENSIONS)
+        catalog.close()
+
+        for f in missing_list:
+            logger.warning('File missing: %s', f)
+
+        for f in untracked_list:
+            logger.warning('File not in catalog: %s', f)
+
+        if missing_list or untracked_list:
+            sys.exit(1)
+
+
     def getFolderSymlinks(self, folder, symlink_list):
         for item in Path(folder).iterdir():
             if item.is_symlink():
@@ -0,0 +1,59 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import multiprocessing
+
+
+logger = multiprocessing.get_logger()
+
+
+class StageTimer(object):
+    ### Rolling per stage durations using the monotonic clock
+
+    def __init__(self, window=100):
+        self.window = int(window)
+
+        self._durations = dict()  # stage => deque of seconds
+
+
+    @contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - start)
+
+
+    def record(self, name, elapsed_s):
+        durations = self._durations.get(name)
+        if durations is None:
+            durations = deque(maxlen=self.window)
+            self._durations[name] = durations
+
+        durations.append(elapsed_s)
+
+
+    def stats(self):
+        stage_stats = dict()
+
+        for name, durations in self._durations.items():
+            if not durations:
+                continue
+
+            values = sorted(durations)
+
+            stage_stats[name] = {
+                'last_ms' : durations[-1] * 1000,
+                'p50_ms'  : self._percentile(values, 50) * 1000,
+                'p95_ms'  : self._percentile(values, 95) * 1000,
+                'max_ms'  : values[-1] * 1000,
+            }
+
+        return stage_stats
+
+
+    def _percentile(self, values, p):
+        return values[min(int(len(values) * p / 100.0), len(values) - 1)]
@@ -1,6 +1,8 @@
 import time
+import threading
+from pathlib import Path
+from collections import OrderedDict
 from multiprocessing import Process
-#from threading import Thread
 
 import multiprocessing
 
@@ -10,7 +12,7 @@ logger = multiprocessing.get_logger()
 
 
 class FileUploader(Process):
-    def __init__(self, idx, config, upload_q):
+    def __init__(self, idx, config, upload_q, upload_elapsed_v=None, upload_count_v=None):
         super(FileUploader, self).__init__()
 
         #self.threadID = idx
@@ -19,61 +21,455 @@ class FileUploader(Process):
         self.config = config
 
         self.upload_q = upload_q
+        self.upload_elapsed_v = upload_elapsed_v
+        self.upload_count_v = upload_count_v
 
 
     def run(self):
+        destinations = list()
+        for d_config in self.getDestinations():
+            destination = UploadDestination(d_config, upload_elapsed_v=self.upload_elapsed_v, upload_count_v=self.upload_count_v)
+            destination.start()
+
+            destinations.append(destination)
+
+
         while True:
             u_dict = self.upload_q.get()
 
             if u_dict.get('stop'):
-                return
+                drain = u_dict.get('drain', False)
+                break
 
-            local_file = u_dict['local_file']
-            remote_file = u_dict['remote_file']
+            destination_list = destinations
+            if u_dict.get('destination') in [d.name for d in destinations]:
+                # resubmitted for a single destination
+                destination_list = [d for d in destinations if d.name == u_dict['destination']]
 
-            try:
-                client_class = getattr(filetransfer, self.config['FILETRANSFER']['CLASSNAME'])
-            except AttributeError:
-                logger.error('Unknown filetransfer class: %s', self.config['FILETRANSFER']['CLASSNAME'])
-                return
+            # every destination has an independent queue
+            for destination in destination_list:
+                destination.add(u_dict)
 
+            #raise Exception('Testing uncaught exception')
 
-            client = client_class(timeout=self.config['FILETRANSFER']['TIMEOUT'])
 
+        for destination in destinations:
+            for u_dict in destination.stop(drain=drain):
+                # unfinished videos are uploaded by the next upload worker
+                u_dict = dict(u_dict)
+                u_dict['destination'] = destination.name
+                self.upload_q.put(u_dict)
 
-            start = time.time()
 
-            try:
-                client.connect(
-                    self.config['FILETRANSFER']['HOST'],
-                    self.config['FILETRANSFER']['USERNAME'],
-                    self.config['FILETRANSFER']['PASSWORD'],
-                    port=self.config['FILETRANSFER']['PORT'],
+    def getDestinations(self):
+        ft_config = self.config['FILETRANSFER']
+
+        dest_list = ft_config.get('DESTINATIONS')
+        if not dest_list:
+            # single destination from the FILETRANSFER settings
+            dest_list = [{}]
+
+        d_config_list = list()
+        for i, dest in enumerate(dest_list):
+            # destination settings override the FILETRANSFER settings
+            d_config = dict(ft_config)
+            d_config.pop('DESTINATIONS', None)
+            d_config.update(dest)
+
+            if not d_config.get('NAME'):
+                d_config['NAME'] = '{0:s}{1:d}'.format(d_config['CLASSNAME'], i)
+
+            d_config_list.append(d_config)
+
+        return d_config_list
+
+
+
+class UploadDestination(object):
+    ### Pending uploads for one destination, transferred by CONCURRENCY threads
+    # A newer job replaces a pending job with the same key
+    # Videos use separate threads so the live image is not delayed by long transfers
+
+    def __init__(self, config, upload_elapsed_v=None, upload_count_v=None):
+        self.config = config
+        self.name = config['NAME']
+
+        self.upload_elapsed_v = upload_elapsed_v
+        self.upload_count_v = upload_count_v
+
+        self.queue_max = int(self.config.get('QUEUE_MAX', 10))
+        self.drop_policy = self.config.get('DROP_POLICY', 'oldest')
+
+        self.concurrency = {
+            'image' : max(1, int(self.config.get('CONCURRENCY', 1))),
+            'video' : max(1, int(self.config.get('VIDEO_CONCURRENCY', 1))),
+        }
+
+        self.keepalive_s = float(self.config.get('KEEPALIVE', 30))
+        self.idle_timeout_s = float(self.config.get('IDLE_TIMEOUT', 300))
+        self.drain_timeout_s = float(self.config.get('DRAIN_TIMEOUT', 1800))
+        self.stop_timeout_s = 5.0  # capture is paused while the worker is restarted
+
+        # the limit is shared by the video threads
+        self.video_rate_limit = int(self.config.get('VIDEO_RATE_LIMIT_KB', 0)) * 1024 // self.concurrency['video']
+
+        self.pending = {
+            'image' : OrderedDict(),
+            'video' : OrderedDict(),
+        }
+        self.active = dict()  # jobs being transferred
+        self.pending_cond = threading.Condition()
+
+        self.stopping = False
+        self.threads = list()
+
+
+    def start(self):
+        for lane, concurrency in self.concurrency.items():
+            logger.info('%s: starting %d %s upload threads', self.name, concurrency, lane)
+
+            for i in range(concurrency):
+                t = threading.Thread(
+                    target=self.worker,
+                    args=(lane,),
+                    name='{0:s}-{1:s}-{2:d}'.format(self.name, lane, i),
+                    daemon=True,
                 )
-            except filetransfer.exceptions.ConnectionFailure as e:
-                logger.error('Connection failure: %s', e)
-                client.close()
-                return
-            except filetransfer.exceptions.AuthenticationFailure as e:
-                logger.error('Authentication failure: %s', e)
-                client.close()
-                return
+                t.start()
+
+                self.threads.append(t)
+
+
+    def stop(self, drain=False):
+        ### Returns the video uploads that were not finished
+        if drain:
+            deadline = time.monotonic() + self.drain_timeout_s
+        else:
+            deadline = time.monotonic() + self.stop_timeout_s
+
+        with self.pending_cond:
+            if drain:
+                # finish all pending uploads
+                if not self.pending_cond.wait_for(lambda: not any(self.pending.values()) and not self.active, timeout=self.drain_timeout_s):
+                    logger.error('%s: uploads not finished after %0.1f s', self.name, self.drain_timeout_s)
+
+            self.stopping = True
+
+            video_list = list(self.pending['video'].values())
+
+            for lane_pending in self.pending.values():
+                if lane_pending:
+                    logger.warning('%s: removing %d pending uploads: %s', self.name, len(lane_pending), ', '.join(lane_pending.keys()))
+                    lane_pending.clear()
+
+            if self.active:
+                logger.warning('%s: uploads in progress: %s', self.name, ', '.join(self.active.keys()))
+
+            self.pending_cond.notify_all()
+
+        # transfers in progress are finished, hung transfers are abandoned
+        for t in self.threads:
+            t.join(timeout=max(deadline - time.monotonic(), 0.0))
+
+            if t.is_alive():
+                logger.error('%s: upload thread %s did not stop', self.name, t.name)
+
+        with self.pending_cond:
+            # videos are resumed, images are replaced by the next image
+            video_list.extend([u_dict for u_dict in self.active.values() if self._lane(u_dict) == 'video'])
+
+        if video_list:
+            logger.warning('%s: %d video uploads not finished', self.name, len(video_list))
+
+        return video_list
+
+
+    def add(self, u_dict):
+        if not u_dict.get('local_file'):
+            logger.warning('%s: no local file to upload', self.name)
+            return
+
+        key = u_dict.get('key', u_dict.get('remote_name', str(u_dict.get('remote_file'))))
+
+        lane_pending = self.pending[self._lane(u_dict)]
+
+        with self.pending_cond:
+            if key in lane_pending:
+                logger.info('%s: replacing pending upload of %s', self.name, key)
+                del lane_pending[key]
+            elif len(lane_pending) >= self.queue_max:
+                if self.drop_policy == 'newest':
+                    logger.warning('%s: upload queue is full, dropping %s', self.name, key)
+                    return
+
+                old_key, old_u_dict = lane_pending.popitem(last=False)
+                logger.warning('%s: upload queue is full, dropping %s', self.name, old_key)
+
+            lane_pending[key] = u_dict
+            self.pending_cond.notify_all()
+
+
+    def _lane(self, u_dict):
+        if u_dict.get('type') == 'video':
+            return 'video'
+
+        return 'image'
+
+
+    def remoteFile(self, u_dict):
+        if not u_dict.get('remote_name'):
+            return u_dict['remote_file']
+
+        if u_dict.get('type') == 'video':
+            remote_folder = self.config['REMOTE_VIDEO_FOLDER']
+        else:
+            remote_folder = self.config['REMOTE_IMAGE_FOLDER']
+
+        return Path(remote_folder).joinpath(u_dict['remote_name'])
+
+
+    def worker(self, lane):
+        session = UploadSession(self.config)
+
+        # wake up periodically while idle
+        wait_s = min([t for t in (self.keepalive_s, self.idle_timeout_s, 60.0) if t > 0])
+
+        while True:
+            with self.pending_cond:
+                job = self._nextJob(lane)
+
+                if not job and not self.stopping:
+                    self.pending_cond.wait(wait_s)
+                    job = self._nextJob(lane)
+
+                if self.stopping:
+                    break
+
+                if job:
+                    self.active[job[0]] = job[1]
+
 
+            if not job:
+                session.idle(self.keepalive_s, self.idle_timeout_s)
+                continue
+
+
+            key, u_dict = job
+
+            try:
+                self.transfer(session, u_dict)
+            except Exception as e:
+                # the thread must survive unexpected errors
+                logger.exception('%s: upload of %s failed: %s', self.name, key, str(e))
+                session.disconnect()
+            finally:
+                with self.pending_cond:
+                    self.active.pop(key, None)
+                    self.pending_cond.notify_all()
+
+
+        session.disconnect()
+
+
+    def _nextJob(self, lane):
+        # the same key is never transferred by two threads at once
+        lane_pending = self.pending[lane]
+
+        for key in lane_pending.keys():
+            if key not in self.active:
+                return key, lane_pending.pop(key)
+
+        return None
+
+
+    def transfer(self, session, u_dict):
+        start = time.monotonic()
+
+        if self._lane(u_dict) == 'video':
+            # large files are resumed and throttled
+            uploaded = session.upload(
+                u_dict['local_file'],
+                self.remoteFile(u_dict),
+                resume=True,
+                rate_limit=self.video_rate_limit,
+            )
+        else:
+            uploaded = session.upload(u_dict['local_file'], self.remoteFile(u_dict))
+
+        if not uploaded:
+            return
+
+        upload_elapsed_s = time.monotonic() - start
+        logger.info('%s: upload completed in %0.4f s', self.name, upload_elapsed_s)
+
+        if self._lane(u_dict) == 'video':
+            # only image uploads are reported in the status
+            return
+
+        if self.upload_count_v:
+            with self.upload_count_v.get_lock():
+                self.upload_elapsed_v.value = upload_elapsed_s
+                self.upload_count_v.value += 1
+
+
+
+class UploadSession(object):
+    ### File transfer session kept open between uploads
+
+    def __init__(self, config):
+        self.config = config
+        self.name = config['NAME']
+
+        self.client = None
+        self.client_last_used = 0.0
+        self.client_last_keepalive = 0.0
+
+
+    def upload(self, local_file, remote_file, resume=False, rate_limit=0):
+        # a broken session is reconnected and the transfer is tried once more
+        # resumable transfers continue from the remote file size with several attempts
+        if resume:
+            attempts = 1 + int(self.config.get('RESUME_RETRIES', 5))
+        else:
+            attempts = 2
+
+        try:
+            local_size = Path(local_file).stat().st_size
+        except OSError as e:
+            logger.error('%s: unable to read %s: %s', self.name, local_file, str(e))
+            return False
+
+
+        for attempt in range(attempts):
+            if attempt and resume:
+                time.sleep(min(2 ** attempt, 60))  # back off before reconnecting
+
+            if not self.connect():
+                continue
+
+            self.client.rate_limit = rate_limit
 
-            # Upload file
             try:
-                client.put(local_file, remote_file)
+                offset = 0
+
+                if resume:
+                    remote_size = self.client.size(remote_file)
+
+                    if remote_size == local_size:
+                        logger.warning('%s: %s is already uploaded', self.name, remote_file)
+                        return True
+
+                    if remote_size and remote_size < local_size:
+                        offset = remote_size
+
+                self.client.put(local_file, remote_file, offset=offset)
+
+                if resume:
+                    # verify the upload is complete
+                    remote_size = self.client.size(remote_file)
+                    if remote_size != local_size:
+                        logger.error('%s: size mismatch for %s: local %d, remote %r', self.name, remote_file, local_size, remote_size)
+                        return False
+            except filetransfer.exceptions.ConnectionFailure as e:
+                logger.error('%s: connection lost during transfer: %s', self.name, e)
+                self.disconnect()
+                continue
             except filetransfer.exceptions.TransferFailure as e:
-                logger.error('Tranfer failure: %s', e)
-                client.close()
-                return
+                logger.error('%s: tranfer failure: %s', self.name, e)
+                return False
+
+            self.client_last_used = time.monotonic()
+
+            return True
+
+        return False
+
 
-            # close file transfer client
+    def connect(self):
+        if self.client:
+            if self.client.is_connected() and self._verify():
+                # reuse session
+                return True
+
+            logger.warning('%s: session is no longer connected, reconnecting', self.name)
+            self.disconnect()
+
+
+        try:
+            client_class = getattr(filetransfer, self.config['CLASSNAME'])
+        except AttributeError:
+            logger.error('%s: unknown filetransfer class: %s', self.name, self.config['CLASSNAME'])
+            return False
+
+
+        client = client_class(timeout=self.config['TIMEOUT'])
+
+        start = time.monotonic()
+
+        try:
+            client.connect(
+                self.config['HOST'],
+                self.config['USERNAME'],
+                self.config['PASSWORD'],
+                port=self.config['PORT'],
+            )
+        except filetransfer.exceptions.ConnectionFailure as e:
+            logger.error('%s: connection failure: %s', self.name, e)
+            client.close()
+            return False
+        except filetransfer.exceptions.AuthenticationFailure as e:
+            logger.error('%s: authentication failure: %s', self.name, e)
             client.close()
+            return False
 
-            upload_elapsed_s = time.time() - start
-            logger.info('Upload completed in %0.4f s', upload_elapsed_s)
+        connect_elapsed_s = time.monotonic() - start
+        logger.info('%s: connected in %0.4f s', self.name, connect_elapsed_s)
 
+        self.client = client
+        self.client_last_used = time.monotonic()
+        self.client_last_keepalive = self.client_last_used
 
-            #raise Exception('Testing uncaught exception')
+        return True
+
+
+    def _verify(self):
+        # the server may have closed a session that was idle, the socket is not closed locally
+        # keepalive interval is used even when keepalives are disabled
+        verify_s = float(self.config.get('KEEPALIVE', 30)) or 30.0
+
+        now = time.monotonic()
+
+        if now - max(self.client_last_used, self.client_last_keepalive) < verify_s:
+            return True
+
+        self.client_last_keepalive = now
+
+        return self.client.keepalive()
+
+
+    def disconnect(self):
+        if not self.client:
+            return
+
+        logger.info('%s: closing file transfer session', self.name)
+        self.client.close()
+        self.client = None
+
+
+    def idle(self, keepalive_s, idle_timeout_s):
+        if not self.client:
+            return
+
+        now = time.monotonic()
+
+        if idle_timeout_s > 0 and now - self.client_last_used > idle_timeout_s:
+            logger.info('%s: session idle for %0.1f s', self.name, now - self.client_last_used)
+            self.disconnect()
+            return
+
+        if keepalive_s > 0 and now - max(self.client_last_used, self.client_last_keepalive) >= keepalive_s:
+            self.client_last_keepalive = now
 
+            if not self.client.keepalive():
+                # reconnect on next upload
+                self.disconnect()
@@ -1,15 +1,24 @@
 import os
 import io
 import time
+import json
+import queue
+import threading
 from pathlib import Path
+from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
 import fcntl
-import errno
+import tempfile
 
 from multiprocessing import Process
 #from threading import Thread
 import multiprocessing
 
+from .catalog import ImageCatalog
+
 logger = multiprocessing.get_logger()
 
 
@@ -17,7 +26,7 @@ VIDEO_LOCKFILE = '/tmp/timelapse_video.lock'
 
 
 class VideoProcessWorker(Process):
-    def __init__(self, idx, config, video_q):
+    def __init__(self, idx, config, video_q, upload_q=None):
         super(VideoProcessWorker, self).__init__()
 
         #self.threadID = idx
@@ -25,80 +34,319 @@ class VideoProcessWorker(Process):
 
         self.config = config
         self.video_q = video_q
+        self.upload_q = upload_q
+
+        self.base_dir = Path(__file__).parent.parent.absolute()
+
+        self.job_queue = VideoJobQueue(
+            self.base_dir.joinpath('video_jobs.json'),
+            VIDEO_LOCKFILE,
+            retries=int(self.config.get('VIDEO_JOB_RETRIES', 3)),
+            retry_delay=float(self.config.get('VIDEO_JOB_RETRY_DELAY', 300)),
+        )
+
+        self.parallelism = max(1, int(self.config.get('VIDEO_PARALLELISM', 1)))
 
-        self.f_lock = None
+        self.catalog = None  # opened in the worker process
 
 
     def run(self):
+        if self.config.get('IMAGE_CATALOG', True):
+            self.catalog = ImageCatalog(self.base_dir.joinpath('catalog.sqlite'), self.base_dir)
+
+        # ffmpeg inherits the priority, preexec_fn is not safe with threads
+        os.nice(19)
+
+        executor = ThreadPoolExecutor(max_workers=self.parallelism)
+        running = dict()  # future => job
+
+        stopping = False
+
         while True:
-            v_dict = self.video_q.get()
+            for future in [f for f in running.keys() if f.done()]:
+                job = running.pop(future)
 
-            if v_dict.get('stop'):
-                return
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.exception('Video job %s failed: %s', job['key'], str(e))
+                    result = 'retry'
+
+                if result == 'done':
+                    self.job_queue.complete(job)
+                else:
+                    self.job_queue.fail(job, retry=result == 'retry')
+
+
+            # jobs added by other processes are also started
+            while len(running) < self.parallelism:
+                job = self.job_queue.claim([j['img_folder'] for j in running.values()], limit=self.parallelism)
+                if not job:
+                    break
+
+                running[executor.submit(self.processJob, job)] = job
+
+
+            if stopping and not running:
+                # jobs waiting for a retry are left in the queue
+                break
+
+
+            if running:
+                wait_s = 1.0
+            else:
+                wait_s = 60.0
 
             try:
-                self._getLock()  # get lock to prevent multiple videos from being concurrently generated
-            except BlockingIOError as e:
-                if e.errno == errno.EAGAIN:
-                    logger.error('Failed to get exclusive lock: %s', str(e))
-                    return
+                v_dict = self.video_q.get(timeout=wait_s)
+            except queue.Empty:
+                continue
+
+            if v_dict.get('stop'):
+                # finish queued jobs first
+                stopping = True
+                continue
 
-            timespec = v_dict['timespec']
-            img_folder = v_dict['img_folder']
+            self.job_queue.add(v_dict)
 
 
-            if not img_folder.exists():
-                logger.error('Image folder does not exist: %s', img_folder)
-                return
+        executor.shutdown(wait=True)
+
+        if self.catalog:
+            self.catalog.close()
+
 
+    def processJob(self, job):
+        ### Returns done, retry or failed
+        timespec = job['timespec']
+        img_folder = Path(job['img_folder'])
 
-            video_file = img_folder.joinpath('allsky-{0:s}.mp4'.format(timespec))
+        logger.info('Starting video job %s (attempt %d)', job['key'], job['attempts'] + 1)
 
+
+        if not img_folder.exists():
+            logger.error('Image folder does not exist: %s', img_folder)
+            return 'failed'
+
+
+        video_file = img_folder.joinpath('allsky-{0:s}.mp4'.format(timespec))
+
+        if job.get('segments'):
             if video_file.exists():
-                logger.warning('Video is already generated: %s', video_file)
-                return
+                # final video was generated while the job was waiting
+                logger.warning('Video is already generated, skipping segments: %s', video_file)
+                return 'done'
 
+            # encode completed hours while the night is in progress
+            segment_list = self.generateSegments(img_folder, self.getTimelapseFiles(img_folder), exclude_folder=job.get('exclude_folder'))
 
-            seqfolder = img_folder.joinpath('.sequence')
+            if segment_list is None:
+                return 'retry'
 
-            if not seqfolder.exists():
-                logger.info('Creating sequence folder %s', seqfolder)
-                seqfolder.mkdir()
+            return 'done'
 
 
-            # delete all existing symlinks in seqfolder
-            rmlinks = list(filter(lambda p: p.is_symlink(), seqfolder.iterdir()))
-            if rmlinks:
-                logger.warning('Removing existing symlinks in %s', seqfolder)
-                for l_p in rmlinks:
-                    l_p.unlink()
+        if video_file.exists():
+            logger.warning('Video is already generated: %s', video_file)
+            return 'done'
 
 
-            # find all files
-            timelapse_files = list()
-            self.getFolderFilesByExt(img_folder, timelapse_files)
+        # find all files, ordered by the timestamp in the filename
+        timelapse_files = self.getTimelapseFiles(img_folder)
+
+        if not timelapse_files:
+            logger.error('No images found in %s', img_folder)
+            return 'failed'
+
+
+        start = time.time()
+
+        if self.config.get('FFMPEG_SEGMENTS'):
+            ffmpeg_returncode = self.generateSegmentedVideo(img_folder, timelapse_files, video_file)
+        else:
+            ffmpeg_returncode = self.generateVideo(img_folder, timelapse_files, video_file)
+
+        elapsed_s = time.time() - start
+        logger.info('Timelapse generated in %0.4f s', elapsed_s)
+
+        rendition_list = self.getRenditions(video_file)
+
+        if ffmpeg_returncode != 0:
+            logger.error('FFMPEG failed with return code %d', ffmpeg_returncode)
+
+            # partial video would prevent a retry
+            for f in [video_file] + [r[1] for r in rendition_list]:
+                try:
+                    f.unlink()
+                except FileNotFoundError:
+                    pass
+
+            return 'retry'
+
+
+        # segments waiting for a retry are no longer needed
+        self.job_queue.discard('{0:s}_segments'.format(job['key']))
+
+        output_list = list()
+
+        size = self.recordVideo(video_file, timespec, img_folder.name == 'night', 'video')
+        output_list.append({ 'name' : 'video', 'format' : video_file.suffix.lstrip('.'), 'file' : str(video_file), 'size' : size })
+
+        self.uploadVideo(video_file)
+
+        for r, rendition_file in rendition_list:
+            size = self.recordVideo(rendition_file, timespec, img_folder.name == 'night', 'video_{0:s}'.format(r['NAME']))
+            output_list.append({ 'name' : r['NAME'], 'format' : r.get('FORMAT', 'mp4'), 'file' : str(rendition_file), 'size' : size })
+
+            if r.get('UPLOAD'):
+                self.uploadVideo(rendition_file)
+
+        self.write_status_json(timespec, img_folder.name == 'night', output_list, elapsed_s)
+
+        return 'done'
+
+
+    def recordVideo(self, video_file, timespec, night, video_type):
+        ### Outputs are logged and added to the catalog, returns the size
+        try:
+            size = video_file.stat().st_size
+        except FileNotFoundError:
+            logger.error('Video output missing: %s', video_file)
+            return None
+
+        logger.info('Video output %s: %s (%d bytes)', video_type, video_file, size)
+
+        if self.catalog:
+            self.catalog.addImage(
+                video_file,
+                datetime.now(),
+                timespec,
+                night,
+                image_type=video_type,
+                size=size,
+            )
+
+        return size
+
+
+    def write_status_json(self, timespec, night, output_list, elapsed_s):
+        ### Outputs of the last generated timelapse, missing files have a size of null
+        status = {
+            'name'      : 'indi_video_json',
+            'timespec'  : timespec,
+            'night'     : int(night),
+            'elapsed_s' : elapsed_s,
+            'time'      : int(time.time()),
+            'outputs'   : output_list,
+        }
+
+        with io.open('/tmp/indi_video_status.json', 'w') as f_video_status:
+            json.dump(status, f_video_status, indent=4)
+            f_video_status.flush()
+            f_video_status.close()
+
+
+    def generateVideo(self, img_folder, timelapse_files, video_file, renditions=True):
+        input_mode = self.config.get('FFMPEG_INPUT_MODE', 'concat')
+
+        if input_mode == 'symlink':
+            return self.generateSymlinkVideo(img_folder, timelapse_files, video_file, renditions=renditions)
+        elif input_mode == 'pipe':
+            return self.generatePipeVideo(timelapse_files, video_file, renditions=renditions)
+
+        return self.generateConcatVideo(img_folder, timelapse_files, video_file, renditions=renditions)
+
 
-            # Exclude empty files
-            timelapse_files_nonzero= filter(lambda p: p.stat().st_size != 0, timelapse_files)
+    def generateSegments(self, img_folder, timelapse_files, exclude_folder=None):
+        ### Encode one segment per hour folder
+        # Segments are named after the first frame and the frame count, a segment is
+        # encoded again if frames are added to the hour after it was generated
+        segment_folder = img_folder.joinpath('.segments')
 
-            logger.info('Creating symlinked files for timelapse')
-            timelapse_files_sorted = sorted(timelapse_files_nonzero, key=lambda p: p.stat().st_mtime)
-            for i, f in enumerate(timelapse_files_sorted):
-                symlink_p = seqfolder.joinpath('{0:04d}.{1:s}'.format(i, self.config['IMAGE_FILE_TYPE']))
-                symlink_p.symlink_to(f)
+        if not segment_folder.exists():
+            logger.info('Creating segment folder %s', segment_folder)
+            segment_folder.mkdir()
 
 
+        hour_files = OrderedDict()
+        for f in timelapse_files:
+            hour_files.setdefault(f.parent, []).append(f)
+
+
+        segment_list = list()
+        for hour_folder, files in hour_files.items():
+            if exclude_folder and hour_folder.name == exclude_folder:
+                # hour is still in progress
+                continue
+
+            segment_file = segment_folder.joinpath('{0:s}_{1:d}.mp4'.format(files[0].stem, len(files)))
+
+            if segment_file.exists():
+                segment_list.append(segment_file)
+                continue
+
+
+            # remove outdated segments for this hour
+            for old_segment in segment_folder.glob('{0:s}_*.mp4'.format(files[0].stem)):
+                logger.warning('Removing outdated segment %s', old_segment)
+                old_segment.unlink()
+
+
+            logger.info('Generating segment %s from %d images', segment_file, len(files))
+
+            # segment is not used until complete
+            tmp_segment_file = segment_folder.joinpath('.{0:s}'.format(segment_file.name))
+
             start = time.time()
 
+            ffmpeg_returncode = self.generateVideo(img_folder, files, tmp_segment_file, renditions=False)
+
+            elapsed_s = time.time() - start
+            logger.info('Segment generated in %0.4f s', elapsed_s)
+
+            if ffmpeg_returncode != 0:
+                logger.error('FFMPEG failed with return code %d', ffmpeg_returncode)
+
+                try:
+                    tmp_segment_file.unlink()
+                except FileNotFoundError:
+                    pass
+
+                return None
+
+            tmp_segment_file.replace(segment_file)
+
+            segment_list.append(segment_file)
+
+
+        return segment_list
+
+
+    def generateSegmentedVideo(self, img_folder, timelapse_files, video_file):
+        ### Remaining hours are encoded, then segments are joined without encoding
+        segment_list = self.generateSegments(img_folder, timelapse_files)
+
+        if not segment_list:
+            return 1
+
+
+        segment_folder = img_folder.joinpath('.segments')
+
+        f_list = tempfile.NamedTemporaryFile(mode='w', delete=False, dir=str(segment_folder), prefix='.concat_', suffix='.txt')
+
+        try:
+            f_list.write('ffconcat version 1.0\n')
+            for f in segment_list:
+                f_list.write('file \'{0:s}\'\n'.format(f.name))
+            f_list.close()
+
             cmd = [
                 'ffmpeg',
                 '-y',
-                '-f', 'image2',
-                '-r', '{0:d}'.format(self.config['FFMPEG_FRAMERATE']),
-                '-i', '{0:s}/%04d.{1:s}'.format(str(seqfolder), self.config['IMAGE_FILE_TYPE']),
-                '-vcodec', 'libx264',
-                '-b:v', '{0:s}'.format(self.config['FFMPEG_BITRATE']),
-                '-pix_fmt', 'yuv420p',
+                '-f', 'concat',
+                '-safe', '0',
+                '-i', f_list.name,
+                '-c', 'copy',
                 '-movflags', '+faststart',
                 '{0:s}'.format(str(video_file)),
             ]
@@ -107,33 +355,355 @@ class VideoProcessWorker(Process):
                 cmd,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
-                preexec_fn=lambda: os.nice(19),
             )
+        finally:
+            f_list.close()
+            Path(f_list.name).unlink()
 
-            elapsed_s = time.time() - start
-            logger.info('Timelapse generated in %0.4f s', elapsed_s)
+        logger.info('FFMPEG output: %s', ffmpeg_subproc.stdout)
 
-            logger.info('FFMPEG output: %s', ffmpeg_subproc.stdout)
 
-            # delete all existing symlinks in seqfolder
-            rmlinks = list(filter(lambda p: p.is_symlink(), Path(seqfolder).iterdir()))
-            if rmlinks:
-                logger.warning('Removing existing symlinks in %s', seqfolder)
-                for l_p in rmlinks:
-                    l_p.unlink()
+        if ffmpeg_subproc.returncode == 0:
+            # segments are no longer needed
+            for f in segment_folder.iterdir():
+                f.unlink()
 
-
-            # remove sequence folder
             try:
-                seqfolder.rmdir()
+                segment_folder.rmdir()
             except OSError as e:
-                logger.error('Cannote remove sequence folder: %s', str(e))
+                logger.error('Cannot remove segment folder: %s', str(e))
+
+
+        if ffmpeg_subproc.returncode == 0 and self.getRenditions(video_file):
+            # renditions are generated from the joined video
+            return self.generateRenditionVideos(video_file)
+
+        return ffmpeg_subproc.returncode
+
+
+    def generateRenditionVideos(self, video_file):
+        cmd = [
+            'ffmpeg',
+            '-y',
+            '-i', '{0:s}'.format(str(video_file)),
+        ]
+        cmd.extend(self._getRenditionArgs(self.getRenditions(video_file)))
+
+        ffmpeg_subproc = subprocess.run(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+
+        logger.info('FFMPEG output: %s', ffmpeg_subproc.stdout)
+
+        return ffmpeg_subproc.returncode
+
+
+    def generateConcatVideo(self, img_folder, timelapse_files, video_file, renditions=True):
+        ### ffmpeg reads the frames from an ordered list file
+        frame_duration = 1.0 / self.config['FFMPEG_FRAMERATE']
+
+        f_list = tempfile.NamedTemporaryFile(mode='w', delete=False, dir=str(img_folder), prefix='.concat_', suffix='.txt')
+
+        try:
+            f_list.write('ffconcat version 1.0\n')
+            for f in timelapse_files:
+                f_list.write('file \'{0:s}\'\n'.format(str(f).replace('\'', '\'\\\'\'')))
+                f_list.write('duration {0:0.6f}\n'.format(frame_duration))
+            f_list.close()
+
+            cmd = [
+                'ffmpeg',
+                '-y',
+                '-f', 'concat',
+                '-safe', '0',
+                '-i', f_list.name,
+            ]
+            cmd.extend(self._getFfmpegOutputArgs(video_file, renditions=renditions))
+
+            ffmpeg_subproc = subprocess.run(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            )
+        finally:
+            f_list.close()
+            Path(f_list.name).unlink()
+
+        logger.info('FFMPEG output: %s', ffmpeg_subproc.stdout)
+
+        return ffmpeg_subproc.returncode
+
+
+    def generatePipeVideo(self, timelapse_files, video_file, renditions=True):
+        ### Frames are written to ffmpeg stdin
+        cmd = [
+            'ffmpeg',
+            '-y',
+            '-f', 'image2pipe',
+            '-framerate', '{0:d}'.format(self.config['FFMPEG_FRAMERATE']),
+            '-i', '-',
+        ]
+        cmd.extend(self._getFfmpegOutputArgs(video_file, renditions=renditions))
+
+        # output is written to a file so a full pipe cannot block ffmpeg
+        with tempfile.TemporaryFile() as f_output:
+            ffmpeg_subproc = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE,
+                stdout=f_output,
+                stderr=subprocess.STDOUT,
+            )
+
+            try:
+                for f in timelapse_files:
+                    try:
+                        with io.open(str(f), 'rb') as f_img:
+                            ffmpeg_subproc.stdin.write(f_img.read())
+                    except FileNotFoundError:
+                        logger.warning('Image removed during video generation: %s', f)
+            except BrokenPipeError:
+                logger.error('FFMPEG closed the input pipe')
+            finally:
+                try:
+                    ffmpeg_subproc.stdin.close()
+                except BrokenPipeError:
+                    pass
 
+            ffmpeg_subproc.wait()
 
-            self._releaseLock()
+            f_output.seek(0)
+            logger.info('FFMPEG output: %s', f_output.read())
 
+        return ffmpeg_subproc.returncode
 
-    def getFolderFilesByExt(self, folder, file_list, extension_list=None):
+
+    def generateSymlinkVideo(self, img_folder, timelapse_files, video_file, renditions=True):
+        ### ffmpeg reads a numbered sequence of symlinks
+        seqfolder = img_folder.joinpath('.sequence')
+
+        if not seqfolder.exists():
+            logger.info('Creating sequence folder %s', seqfolder)
+            seqfolder.mkdir()
+
+
+        # delete all existing symlinks in seqfolder
+        self._removeSymlinks(seqfolder)
+
+
+        logger.info('Creating symlinked files for timelapse')
+        for i, f in enumerate(timelapse_files):
+            symlink_p = seqfolder.joinpath('{0:04d}.{1:s}'.format(i, self.config['IMAGE_FILE_TYPE']))
+            symlink_p.symlink_to(f)
+
+
+        cmd = [
+            'ffmpeg',
+            '-y',
+            '-f', 'image2',
+            '-r', '{0:d}'.format(self.config['FFMPEG_FRAMERATE']),
+            '-i', '{0:s}/%04d.{1:s}'.format(str(seqfolder), self.config['IMAGE_FILE_TYPE']),
+        ]
+        cmd.extend(self._getFfmpegOutputArgs(video_file, renditions=renditions))
+
+        ffmpeg_subproc = subprocess.run(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+
+        logger.info('FFMPEG output: %s', ffmpeg_subproc.stdout)
+
+
+        # delete all existing symlinks in seqfolder
+        self._removeSymlinks(seqfolder)
+
+
+        # remove sequence folder
+        try:
+            seqfolder.rmdir()
+        except OSError as e:
+            logger.error('Cannote remove sequence folder: %s', str(e))
+
+
+        return ffmpeg_subproc.returncode
+
+
+    def _getFfmpegOutputArgs(self, video_file, renditions=True):
+        output_args = [
+            '-r', '{0:d}'.format(self.config['FFMPEG_FRAMERATE']),
+            '-vcodec', 'libx264',
+            '-b:v', '{0:s}'.format(self.config['FFMPEG_BITRATE']),
+            '-pix_fmt', 'yuv420p',
+            '-movflags', '+faststart',
+            '{0:s}'.format(str(video_file)),
+        ]
+
+        if not renditions:
+            return output_args
+
+        rendition_list = self.getRenditions(video_file)
+        if not rendition_list:
+            return output_args
+
+        return self._getRenditionArgs(rendition_list, main_args=output_args)
+
+
+    def getRenditions(self, video_file):
+        ### Additional outputs, allsky-<timespec>-<name>.<format>
+        rendition_list = list()
+
+        for r in self.config.get('FFMPEG_RENDITIONS', []):
+            rendition_file = video_file.with_name('{0:s}-{1:s}.{2:s}'.format(video_file.stem, r['NAME'], r.get('FORMAT', 'mp4')))
+            rendition_list.append((r, rendition_file))
+
+        return rendition_list
+
+
+    def _getRenditionArgs(self, rendition_list, main_args=None):
+        ### The input is decoded once and split for every output
+        output_count = len(rendition_list)
+        if main_args:
+            output_count += 1
+
+        split_labels = ['[s{0:d}]'.format(i) for i in range(output_count)]
+
+        filter_list = ['[0:v]split={0:d}{1:s}'.format(output_count, ''.join(split_labels))]
+        output_args = list()
+
+        if main_args:
+            output_args.extend(['-map', split_labels.pop(0)])
+            output_args.extend(main_args)
+
+
+        for i, (r, rendition_file) in enumerate(rendition_list):
+            r_format = r.get('FORMAT', 'mp4')
+            r_label = '[r{0:d}]'.format(i)
+
+            r_filters = list()
+            if r.get('FRAMERATE'):
+                r_filters.append('fps={0:d}'.format(r['FRAMERATE']))
+
+            if r_format in ('gif', 'webp'):
+                if r.get('WIDTH'):
+                    r_filters.append('scale={0:d}:-1:flags=lanczos'.format(r['WIDTH']))
+            elif r.get('WIDTH'):
+                r_filters.append('scale={0:d}:-2'.format(r['WIDTH']))  # even height for yuv420p
+
+            if not r_filters:
+                r_filters.append('null')
+
+
+            if r_format == 'gif':
+                # palette is generated from the frames of the rendition
+                filter_list.append('{0:s}{1:s},split[ga{2:d}][gb{2:d}];[ga{2:d}]palettegen[gp{2:d}];[gb{2:d}][gp{2:d}]paletteuse{3:s}'.format(split_labels[i], ','.join(r_filters), i, r_label))
+
+                output_args.extend(['-map', r_label, '-loop', '0'])
+            elif r_format == 'webp':
+                filter_list.append('{0:s}{1:s}{2:s}'.format(split_labels[i], ','.join(r_filters), r_label))
+
+                output_args.extend([
+                    '-map', r_label,
+                    '-vcodec', 'libwebp',
+                    '-q:v', '{0:d}'.format(r.get('QUALITY', 60)),
+                    '-loop', '0',
+                ])
+            else:
+                filter_list.append('{0:s}{1:s}{2:s}'.format(split_labels[i], ','.join(r_filters), r_label))
+
+                output_args.extend([
+                    '-map', r_label,
+                    '-r', '{0:d}'.format(r.get('FRAMERATE', self.config['FFMPEG_FRAMERATE'])),
+                    '-vcodec', r.get('CODEC', 'libx264'),
+                ])
+
+                if r.get('CRF') is not None:
+                    output_args.extend(['-crf', '{0:d}'.format(r['CRF'])])
+                else:
+                    output_args.extend(['-b:v', r.get('BITRATE', self.config['FFMPEG_BITRATE'])])
+
+                output_args.extend(['-pix_fmt', 'yuv420p'])
+
+                if r_format in ('mp4', 'mov'):
+                    output_args.extend(['-movflags', '+faststart'])
+
+
+            output_args.append('{0:s}'.format(str(rendition_file)))
+
+
+        return ['-filter_complex', ';'.join(filter_list)] + output_args
+
+
+    def _removeSymlinks(self, seqfolder):
+        rmlinks = list(filter(lambda p: p.is_symlink(), seqfolder.iterdir()))
+        if rmlinks:
+            logger.warning('Removing existing symlinks in %s', seqfolder)
+            for l_p in rmlinks:
+                l_p.unlink()
+
+
+    def uploadVideo(self, video_file):
+        if not self.config['FILETRANSFER']['UPLOAD_VIDEO']:
+            logger.warning('Video uploading disabled')
+            return
+
+        if not self.upload_q:
+            logger.error('Upload worker not available, video not uploaded')
+            return
+
+        # tell worker to upload file, the remote folder is set per destination
+        self.upload_q.put({ 'local_file' : video_file, 'remote_name' : video_file.name, 'type' : 'video', 'key' : video_file.name })
+
+
+    def getTimelapseFiles(self, img_folder):
+        timelapse_files = list()
+
+        if self.catalog:
+            # images/<day>/<night|day>
+            catalog_files = self.catalog.getImages(day_date=img_folder.parent.name, night=img_folder.name == 'night')
+            logger.info('Found %d images for %s in catalog', len(catalog_files), img_folder)
+
+            if self.config.get('IMAGE_CATALOG_VERIFY', False):
+                timelapse_files = self.verifyCatalogFiles(img_folder, catalog_files)
+            else:
+                # catalogCheck repairs differences with the files on disk
+                timelapse_files = catalog_files
+
+        if not timelapse_files:
+            # catalog disabled or not built for this folder
+            self.getFolderFilesByExt(img_folder, timelapse_files)
+
+        # filenames start with the exposure timestamp
+        timelapse_files.sort(key=lambda p: p.name)
+
+        return timelapse_files
+
+
+    def verifyCatalogFiles(self, img_folder, catalog_files):
+        # files are listed without stat() to verify the catalog is complete
+        folder_files = list()
+        self.getFolderFilesByExt(img_folder, folder_files, check_size=False)
+
+        folder_file_set = set(folder_files)
+        catalog_file_set = set(f for f in catalog_files if f in folder_file_set)
+
+        untracked_files = [f for f in folder_files if f not in catalog_file_set]
+        if untracked_files:
+            logger.warning('%d images in %s are not in the catalog', len(untracked_files), img_folder)
+
+        if len(catalog_file_set) != len(catalog_files):
+            logger.warning('%d catalog entries for %s have no file', len(catalog_files) - len(catalog_file_set), img_folder)
+
+        # empty files are excluded, cataloged files are complete
+        timelapse_files = list(catalog_file_set)
+        timelapse_files.extend(f for f in untracked_files if f.stat().st_size != 0)
+
+        return timelapse_files
+
+
+    def getFolderFilesByExt(self, folder, file_list, extension_list=None, check_size=True):
+        ### Empty files and hidden files (temp files, .sequence) are excluded
         if not extension_list:
             extension_list = [self.config['IMAGE_FILE_TYPE']]
 
@@ -141,28 +711,250 @@ class VideoProcessWorker(Process):
 
         dot_extension_list = ['.{0:s}'.format(e) for e in extension_list]
 
-        for item in Path(folder).iterdir():
-            if item.is_file() and item.suffix in dot_extension_list:
-                file_list.append(item)
-            elif item.is_dir():
-                self.getFolderFilesByExt(item, file_list, extension_list=extension_list)  # recursion
+        with os.scandir(str(folder)) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+
+                if entry.is_dir(follow_symlinks=False):
+                    self.getFolderFilesByExt(entry.path, file_list, extension_list=extension_list, check_size=check_size)  # recursion
+                elif entry.is_file() and os.path.splitext(entry.name)[1] in dot_extension_list:
+                    if check_size and entry.stat().st_size == 0:
+                        continue
+
+                    file_list.append(Path(entry.path))
+
+
+
+class VideoJobQueue(object):
+    ### Video jobs stored in a JSON file shared by all processes
+    # One job per timespec and day/night, jobs are claimed by the process generating the video
+    # Failed jobs are retried with an increasing delay
+
+    def __init__(self, queue_file, lock_file, retries=3, retry_delay=300.0):
+        self.queue_file = Path(queue_file)
+        self.lock_file = Path(lock_file)
+
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self._thread_lock = threading.Lock()
+
+
+    @contextmanager
+    def _jobs(self):
+        ### Read, modify and write the job list while holding the lock
+        with self._thread_lock:
+            with io.open(str(self.lock_file), 'a+') as f_lock:
+                fcntl.flock(f_lock, fcntl.LOCK_EX)
+
+                try:
+                    jobs = self._load()
+                    yield jobs
+                    self._save(jobs)
+                finally:
+                    fcntl.flock(f_lock, fcntl.LOCK_UN)
+
+
+    def _load(self):
+        if not self.queue_file.exists():
+            return list()
+
+        try:
+            with io.open(str(self.queue_file), 'r') as f_queue:
+                return json.load(f_queue)
+        except ValueError as e:
+            logger.error('Video job queue is corrupt, starting empty: %s', str(e))
+            self.queue_file.replace(self.queue_file.with_suffix('.bad'))
+            return list()
+
+
+    def _save(self, jobs):
+        f_tmp = tempfile.NamedTemporaryFile(mode='w', delete=False, dir=str(self.queue_file.parent), prefix='.', suffix='.json')
+
+        try:
+            json.dump(jobs, f_tmp, indent=4)
+            f_tmp.close()
+
+            Path(f_tmp.name).replace(self.queue_file)
+        except OSError:
+            f_tmp.close()
+            Path(f_tmp.name).unlink()
+            raise
+
+
+    def add(self, v_dict):
+        img_folder = Path(v_dict['img_folder'])
+
+        key = '{0:s}_{1:s}'.format(v_dict['timespec'], img_folder.name)
+        if v_dict.get('segments'):
+            key += '_segments'
+
+        with self._jobs() as jobs:
+            for job in jobs:
+                if job['key'] != key:
+                    continue
+
+                if job['state'] == 'pending':
+                    # requested again, retry now
+                    logger.warning('Video job %s is already queued', key)
+                    job['next_attempt'] = 0
+                    job['attempts'] = 0
+                    job['exclude_folder'] = v_dict.get('exclude_folder')
+                else:
+                    # images were added while the job is running
+                    logger.warning('Video job %s is already running in process %d, running again when finished', key, job['pid'])
+                    job['dirty'] = True
+                    job['exclude_folder'] = v_dict.get('exclude_folder')
+
+                return False
+
+
+            jobs.append({
+                'key'            : key,
+                'timespec'       : v_dict['timespec'],
+                'img_folder'     : str(img_folder),
+                'segments'       : bool(v_dict.get('segments')),
+                'exclude_folder' : v_dict.get('exclude_folder'),
+                'state'          : 'pending',
+                'attempts'       : 0,
+                'next_attempt'   : 0,
+                'added'          : time.time(),
+                'pid'            : None,
+                'pid_start'      : None,
+                'dirty'          : False,
+            })
+
+        logger.info('Video job %s queued', key)
+
+        return True
+
+
+    def claim(self, busy_folders, limit=1):
+        ### Next job in order, a folder is only used by one job at a time
+        # The limit applies to the running jobs of all processes
+        now = time.time()
+        pid = os.getpid()
+
+        with self._jobs() as jobs:
+            for job in jobs:
+                if job['state'] == 'running' and not self._pidAlive(job['pid'], job.get('pid_start')):
+                    logger.warning('Video job %s was interrupted, requeueing', job['key'])
+                    job['state'] = 'pending'
+                    job['pid'] = None
+                    job['pid_start'] = None
+
+
+            running_jobs = [j for j in jobs if j['state'] == 'running']
+            if len(running_jobs) >= limit:
+                return None
+
+            running_folders = set(busy_folders)
+            running_folders.update(j['img_folder'] for j in running_jobs)
+
+            for job in sorted(jobs, key=lambda j: (j['added'], j['key'])):
+                if job['state'] != 'pending' or job['next_attempt'] > now:
+                    continue
+
+                if job['img_folder'] in running_folders:
+                    continue
+
+                job['state'] = 'running'
+                job['pid'] = pid
+                job['pid_start'] = self._pidStartTime(pid)
+
+                return dict(job)
+
+        return None
+
+
+    def discard(self, key):
+        ### Remove a job that is not running
+        with self._jobs() as jobs:
+            discard_jobs = [j for j in jobs if j['key'] == key and j['state'] == 'pending']
+
+            for j in discard_jobs:
+                logger.warning('Removing video job %s', key)
+                jobs.remove(j)
+
+
+    def complete(self, job):
+        with self._jobs() as jobs:
+            for j in jobs:
+                if j['key'] == job['key'] and j.get('dirty'):
+                    logger.info('Video job %s completed, requeueing', job['key'])
+                    self._requeue(j)
+                    return
+
+            jobs[:] = [j for j in jobs if j['key'] != job['key']]
+
+        logger.info('Video job %s completed', job['key'])
+
+
+    def fail(self, job, retry=True):
+        with self._jobs() as jobs:
+            for j in jobs:
+                if j['key'] != job['key']:
+                    continue
+
+                if j.get('dirty'):
+                    # requested again while running
+                    logger.warning('Video job %s failed, requeueing', j['key'])
+                    self._requeue(j)
+                    return
+
+                j['attempts'] += 1
+
+                if not retry or j['attempts'] > self.retries:
+                    logger.error('Video job %s failed after %d attempt(s), removing', j['key'], j['attempts'])
+                    jobs.remove(j)
+                    return
+
+                delay = min(self.retry_delay * (2 ** (j['attempts'] - 1)), 86400)
+                logger.warning('Video job %s failed, retrying in %d s', j['key'], delay)
+
+                j['state'] = 'pending'
+                j['pid'] = None
+                j['pid_start'] = None
+                j['next_attempt'] = time.time() + delay
+
+                return
+
+
+    def _requeue(self, job):
+        job['state'] = 'pending'
+        job['attempts'] = 0
+        job['next_attempt'] = 0
+        job['pid'] = None
+        job['pid_start'] = None
+        job['dirty'] = False
+
 
+    def _pidAlive(self, pid, pid_start=None):
+        if not pid:
+            return False
 
-    def _getLock(self):
-        logger.info('Get exclusive lock to generate video')
-        lock_p = Path(VIDEO_LOCKFILE)
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
 
-        if not lock_p.is_file():
-            f_lock = io.open(str(lock_p), 'w+')
-            f_lock.close()
-            lock_p.chmod(0o644)
+        if pid_start is not None and self._pidStartTime(pid) != pid_start:
+            # pid was reused by another process
+            return False
 
-        self.f_lock = io.open(str(lock_p), 'w+')
-        fcntl.flock(self.f_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)  # Exclusive, non-blocking lock
+        return True
 
 
-    def _releaseLock(self):
-        logger.info('Release exclusive lock')
-        fcntl.flock(self.f_lock, fcntl.LOCK_UN)
-        self.f_lock.close()
+    def _pidStartTime(self, pid):
+        # process start time in clock ticks after boot, not available on all platforms
+        try:
+            with io.open('/proc/{0:d}/stat'.format(pid), 'r') as f_stat:
+                stat = f_stat.read()
+        except OSError:
+            return None
 
+        # command name may contain spaces
+        return int(stat.rsplit(')', 1)[1].split()[19])
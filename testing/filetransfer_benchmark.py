@@ -0,0 +1,582 @@
+#!/usr/bin/env python3
+
+### Measure the filetransfer classes against local FTP/FTPS/SFTP servers
+# Servers listen on 127.0.0.2, clients connect through a proxy on 127.0.0.1 which adds latency, loss and a bandwidth cap
+# Requires pyftpdlib (and pyopenssl for FTPS)
+
+import sys
+import os
+import io
+import json
+import time
+import queue
+import random
+import socket
+import logging
+import tempfile
+import argparse
+import threading
+import subprocess
+from pathlib import Path
+from datetime import datetime
+
+import multiprocessing
+
+import paramiko
+
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))
+from indi_timelapse import filetransfer  # noqa: E402
+
+
+SERVER_ADDRESS = '127.0.0.2'
+PROXY_ADDRESS = '127.0.0.1'
+
+USERNAME = 'benchmark'
+PASSWORD = 'benchmark'
+
+FILE_SIZES = (300 * 1024, 5 * 1024 * 1024, 50 * 1024 * 1024)
+BLOCK_SIZES = (8192, 32768, 262144, 1048576)
+
+
+logger = multiprocessing.get_logger()
+
+
+class LinkProxy(object):
+    ### TCP proxy emulating a constrained link
+    # TCP cannot lose data, a lost segment is emulated as a retransmission delay which also stalls the following data
+
+    def __init__(self, listen_port, target_port, latency_s=0.0, loss=0.0, bandwidth=0):
+        self.listen_port = listen_port
+        self.target_port = target_port
+
+        self.latency_s = latency_s  # one way
+        self.loss = loss  # probability per segment
+        self.bandwidth = bandwidth  # bytes per second, 0 is unlimited
+
+        self.rto_s = max(0.2, latency_s * 4)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((PROXY_ADDRESS, listen_port))
+        self.sock.listen(16)
+
+
+    def start(self):
+        t = threading.Thread(target=self._accept, daemon=True)
+        t.start()
+
+
+    def _accept(self):
+        while True:
+            try:
+                client_sock, addr = self.sock.accept()
+            except OSError:
+                return
+
+            try:
+                server_sock = socket.create_connection((SERVER_ADDRESS, self.target_port))
+            except OSError:
+                client_sock.close()
+                continue
+
+            for sock in (client_sock, server_sock):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            self._pipe(client_sock, server_sock)
+            self._pipe(server_sock, client_sock)
+
+
+    def _pipe(self, src, dst):
+        segment_q = queue.Queue(maxsize=256)  # limits data in flight
+
+        threading.Thread(target=self._read, args=(src, segment_q), daemon=True).start()
+        threading.Thread(target=self._write, args=(dst, segment_q), daemon=True).start()
+
+
+    def _read(self, src, segment_q):
+        while True:
+            try:
+                data = src.recv(16384)
+            except OSError:
+                data = b''
+
+            segment_q.put((time.monotonic() + self.latency_s, data))
+
+            if not data:
+                return
+
+
+    def _write(self, dst, segment_q):
+        next_free = 0.0
+
+        while True:
+            release, data = segment_q.get()
+
+            if not data:
+                try:
+                    dst.shutdown(socket.SHUT_WR)
+                except OSError:
+                    pass
+                return
+
+            if self.loss and random.random() < self.loss:
+                release += self.rto_s
+
+            if self.bandwidth:
+                release = max(release, next_free)
+                next_free = release + (len(data) / float(self.bandwidth))
+
+            delay = release - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            try:
+                dst.sendall(data)
+            except OSError:
+                return
+
+
+    def close(self):
+        self.sock.close()
+
+
+
+class StubSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+
+
+class StubSFTPServer(paramiko.SFTPServerInterface):
+    ROOT = None  # set before starting the server
+
+    def _realpath(self, path):
+        return self.ROOT + self.canonicalize(path)
+
+
+    def list_folder(self, path):
+        path = self._realpath(path)
+
+        try:
+            return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, f)), f) for f in os.listdir(path)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._realpath(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self._realpath(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+    def open(self, path, flags, attr):
+        path = self._realpath(path)
+
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+
+        f = os.fdopen(fd, mode)
+
+        handle = StubSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = f
+        handle.writefile = f
+
+        return handle
+
+
+    def remove(self, path):
+        try:
+            os.remove(self._realpath(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+        return paramiko.SFTP_OK
+
+
+
+class StubSSHServer(paramiko.ServerInterface):
+    def check_auth_password(self, username, password):
+        if username == USERNAME and password == PASSWORD:
+            return paramiko.AUTH_SUCCESSFUL
+
+        return paramiko.AUTH_FAILED
+
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+
+def free_ports(count):
+    socks = list()
+    for x in range(count):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind((PROXY_ADDRESS, 0))
+        socks.append(s)
+
+    ports = [s.getsockname()[1] for s in socks]
+
+    for s in socks:
+        s.close()
+
+    return ports
+
+
+def start_ftp_server(root, tls=False, cert_file=None):
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.servers import ThreadedFTPServer
+    from pyftpdlib.ioloop import IOLoop
+
+    if tls:
+        from pyftpdlib.handlers import TLS_FTPHandler as BaseHandler
+    else:
+        from pyftpdlib.handlers import FTPHandler as BaseHandler
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(USERNAME, PASSWORD, str(root), perm='elradfmwMT')
+
+    handler = type('BenchmarkFTPHandler', (BaseHandler,), {})
+    handler.authorizer = authorizer
+    handler.masquerade_address = PROXY_ADDRESS  # data connections go through the proxy
+    handler.passive_ports = free_ports(4)
+
+    if tls:
+        handler.certfile = str(cert_file)
+
+    control_port = free_ports(1)[0]
+
+    # exit event and lock are class attributes, servers are closed independently
+    server_class = type('BenchmarkFTPServer', (ThreadedFTPServer,), {'_lock' : threading.Lock(), '_exit' : threading.Event()})
+
+    server = server_class((SERVER_ADDRESS, control_port), handler, ioloop=IOLoop())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, [control_port] + list(handler.passive_ports)
+
+
+def start_sftp_server(root):
+    StubSFTPServer.ROOT = str(root)
+
+    host_key = paramiko.RSAKey.generate(2048)
+
+    control_port = free_ports(1)[0]
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((SERVER_ADDRESS, control_port))
+    sock.listen(16)
+
+    def accept():
+        while True:
+            try:
+                client_sock, addr = sock.accept()
+            except OSError:
+                return
+
+            transport = paramiko.Transport(client_sock)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, StubSFTPServer)
+            transport.start_server(server=StubSSHServer())
+
+    threading.Thread(target=accept, daemon=True).start()
+
+    return sock, [control_port]
+
+
+def generate_cert(cert_file):
+    from OpenSSL import crypto
+
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+
+    cert = crypto.X509()
+    cert.get_subject().CN = 'localhost'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(86400)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+
+    with io.open(str(cert_file), 'wb') as f_cert:
+        f_cert.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+        f_cert.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def connect(protocol, port, timeout):
+    client = getattr(filetransfer, protocol)(timeout=timeout)
+    client.connect(PROXY_ADDRESS, USERNAME, PASSWORD, port=port)
+    return client
+
+
+def run_protocol(protocol, port, root, args):
+    result = {
+        'protocol' : protocol,
+    }
+
+
+    ### connect latency including the TLS/SSH handshake and login
+    connect_times = list()
+    for x in range(args.iterations):
+        start = time.perf_counter()
+        client = connect(protocol, port, args.timeout)
+        connect_times.append(time.perf_counter() - start)
+        client.close()
+
+    result['connect_ms'] = {
+        'p50' : percentile(connect_times, 50) * 1000,
+        'max' : max(connect_times) * 1000,
+    }
+
+
+    ### per file overhead on an open session
+    small_file = root.joinpath('local', 'small.bin')
+    small_file.write_bytes(os.urandom(1024))
+
+    client = connect(protocol, port, args.timeout)
+
+    file_times = list()
+    for x in range(args.iterations * 5):
+        start = time.perf_counter()
+        client.put(small_file, '/small_{0:d}.bin'.format(x))
+        file_times.append(time.perf_counter() - start)
+
+    client.close()
+
+    result['per_file_ms'] = {
+        'p50' : percentile(file_times, 50) * 1000,
+        'max' : max(file_times) * 1000,
+    }
+
+
+    ### bulk throughput
+    result['throughput'] = list()
+
+    for file_size in args.file_size:
+        local_file = root.joinpath('local', 'bulk_{0:d}.bin'.format(file_size))
+        if not local_file.exists():
+            local_file.write_bytes(os.urandom(file_size))
+
+        for block_size in args.block_size:
+            client = connect(protocol, port, args.timeout)
+            client.block_size = block_size
+
+            times = list()
+            for x in range(args.iterations):
+                remote_file = '/bulk_{0:d}_{1:d}.bin'.format(file_size, block_size)
+
+                start = time.perf_counter()
+                client.put(local_file, remote_file)
+                times.append(time.perf_counter() - start)
+
+                if root.joinpath('remote', remote_file.lstrip('/')).stat().st_size != file_size:
+                    raise Exception('Size mismatch: {0:s}'.format(remote_file))
+
+            client.close()
+
+            result['throughput'].append({
+                'file_size'  : file_size,
+                'block_size' : block_size,
+                'p50_s'      : percentile(times, 50),
+                'mb_per_s'   : file_size / percentile(times, 50) / 1048576,
+            })
+
+            print('{0:>5s} {1:>10d} bytes block {2:>8d}: {3:0.2f} MB/s'.format(protocol, file_size, block_size, result['throughput'][-1]['mb_per_s']), file=sys.stderr)
+
+
+    return result
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--protocol',
+        '-p',
+        help='protocols',
+        choices=('ftp', 'ftps', 'sftp'),
+        action='append',
+    )
+    argparser.add_argument(
+        '--iterations',
+        '-i',
+        help='iterations per test',
+        type=int,
+        default=3,
+    )
+    argparser.add_argument(
+        '--file-size',
+        help='file sizes in bytes',
+        type=int,
+        action='append',
+    )
+    argparser.add_argument(
+        '--block-size',
+        help='block sizes in bytes',
+        type=int,
+        action='append',
+    )
+    argparser.add_argument(
+        '--latency',
+        help='round trip latency in ms',
+        type=float,
+        default=0.0,
+    )
+    argparser.add_argument(
+        '--loss',
+        help='segment loss in percent',
+        type=float,
+        default=0.0,
+    )
+    argparser.add_argument(
+        '--bandwidth',
+        help='bandwidth cap in KB/s per direction, 0 is unlimited',
+        type=int,
+        default=0,
+    )
+    argparser.add_argument(
+        '--timeout',
+        help='client timeout',
+        type=float,
+        default=30.0,
+    )
+    argparser.add_argument(
+        '--output',
+        '-o',
+        help='json output file',
+        type=str,
+    )
+
+    args = argparser.parse_args()
+
+    if not args.protocol:
+        args.protocol = ['ftp', 'ftps', 'sftp']
+
+    if not args.file_size:
+        args.file_size = list(FILE_SIZES)
+
+    if not args.block_size:
+        args.block_size = list(BLOCK_SIZES)
+
+
+    # server and client logging is noisy
+    logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+    logging.getLogger('paramiko').setLevel(logging.WARNING)
+
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    root = Path(tmp_dir.name)
+    root.joinpath('local').mkdir()
+    root.joinpath('remote').mkdir()
+
+
+    results = list()
+
+    for protocol in args.protocol:
+        try:
+            if protocol == 'sftp':
+                server, ports = start_sftp_server(root.joinpath('remote'))
+            elif protocol == 'ftps':
+                cert_file = root.joinpath('cert.pem')
+                generate_cert(cert_file)
+                server, ports = start_ftp_server(root.joinpath('remote'), tls=True, cert_file=cert_file)
+            else:
+                server, ports = start_ftp_server(root.joinpath('remote'))
+        except ImportError as e:
+            print('Skipping {0:s}: {1:s}'.format(protocol, str(e)), file=sys.stderr)
+            continue
+
+
+        # every server port is proxied, including FTP passive ports
+        proxies = list()
+        for port in ports:
+            proxy = LinkProxy(
+                port,
+                port,
+                latency_s=args.latency / 2000.0,
+                loss=args.loss / 100.0,
+                bandwidth=args.bandwidth * 1024,
+            )
+            proxy.start()
+            proxies.append(proxy)
+
+
+        print('Running {0:s}'.format(protocol), file=sys.stderr)
+        results.append(run_protocol(protocol, ports[0], root, args))
+
+
+        for proxy in proxies:
+            proxy.close()
+
+        if protocol == 'sftp':
+            server.close()
+        else:
+            server.close_all()
+
+
+    tmp_dir.cleanup()
+
+
+    try:
+        git_commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=str(Path(__file__).parent),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        ).stdout.decode().strip()
+    except FileNotFoundError:
+        git_commit = None
+
+
+    report = {
+        'time'      : datetime.now().strftime('%s'),
+        'commit'    : git_commit,
+        'latency'   : args.latency,
+        'loss'      : args.loss,
+        'bandwidth' : args.bandwidth,
+        'results'   : results,
+    }
+
+    if args.output:
+        with io.open(args.output, 'w') as f_output:
+            json.dump(report, f_output, indent=4)
+            f_output.write('\n')
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        sys.stdout.write('\n')
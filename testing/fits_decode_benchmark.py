@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+### Compare the fast FITS decoder with the astropy decode path used previously
+
+import sys
+import io
+import json
+import time
+import argparse
+from datetime import datetime
+from pathlib import Path
+
+import numpy
+from astropy.io import fits
+
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))
+from indi_timelapse import fastfits  # noqa: E402
+from indi_timelapse.overlay import OverlayRenderer  # noqa: E402
+
+
+SENSOR_SIZES = (
+    (1920, 1080),   # 2MP
+    (3096, 2080),   # 6MP
+    (5496, 3672),   # 20MP
+)
+
+
+def generate_fits(width, height, bits):
+    if bits == 8:
+        data = numpy.random.randint(0, 255, size=(height, width), dtype=numpy.uint8)
+    else:
+        data = numpy.random.randint(0, 65535, size=(height, width), dtype=numpy.uint16)
+
+    f_blob = io.BytesIO()
+    fits.PrimaryHDU(data).writeto(f_blob)
+
+    return data, f_blob.getvalue()
+
+
+def decode_astropy(blob):
+    hdulist = fits.open(io.BytesIO(blob))
+    data = hdulist[0].data
+    return data
+
+
+def decode_fast(blob):
+    return fastfits.decode(blob)
+
+
+def check_overlay(config, blob):
+    ### Frames from the queue arrive as bytes, the overlay draws on the decoded image
+    data = fastfits.decode(blob)
+
+    if not data.flags.writeable:
+        raise Exception('Decoded image is read-only')
+
+    OverlayRenderer(config).render(data, datetime.now(), [('Exposure ', '1.000000')])
+
+
+def run(label, func, blob, iterations, writable=False):
+    timings = list()
+
+    for x in range(iterations):
+        if writable:
+            buf = bytearray(blob)  # copy outside of timing
+        else:
+            buf = blob
+
+        start = time.perf_counter()
+        func(buf)
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+
+    return {
+        'label'  : label,
+        'p50'    : timings[int(len(timings) * 0.5)] * 1000,
+        'p95'    : timings[min(int(len(timings) * 0.95), len(timings) - 1)] * 1000,
+        'min'    : timings[0] * 1000,
+    }
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--iterations',
+        '-i',
+        help='iterations per test',
+        type=int,
+        default=20,
+    )
+    argparser.add_argument(
+        '--config',
+        '-c',
+        help='config file, the overlay is checked when set',
+        type=argparse.FileType('r'),
+    )
+
+    args = argparser.parse_args()
+
+    config = None
+    if args.config:
+        config = json.loads(args.config.read())
+
+
+    print('{0:>12s} {1:>4s} {2:>22s} {3:>10s} {4:>10s} {5:>10s}'.format('size', 'bits', 'decoder', 'p50 ms', 'p95 ms', 'min ms'))
+
+    for width, height in SENSOR_SIZES:
+        for bits in (8, 16):
+            data, blob = generate_fits(width, height, bits)
+
+            # verify the results match
+            if not numpy.array_equal(decode_fast(bytearray(blob)), data):
+                raise Exception('Fast decoder mismatch: {0:d}x{1:d} {2:d} bit'.format(width, height, bits))
+
+            if config:
+                check_overlay(config, blob)
+
+
+            results = list()
+            results.append(run('astropy', decode_astropy, blob, args.iterations))
+
+            # read-only buffer, data is copied
+            results.append(run('fastfits (bytes)', decode_fast, blob, args.iterations))
+
+            # writable buffer like the shared memory frame buffer, decoded in place
+            results.append(run('fastfits (writable)', decode_fast, blob, args.iterations, writable=True))
+
+            for r in results:
+                print('{0:>12s} {1:>4d} {2:>22s} {3:>10.3f} {4:>10.3f} {5:>10.3f}'.format(
+                    '{0:d}x{1:d}'.format(width, height),
+                    bits,
+                    r['label'],
+                    r['p50'],
+                    r['p95'],
+                    r['min'],
+                ))
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+### Measure the ImageProcessWorker stages offline with synthetic frames
+# Each case runs in a separate process so peak RSS is reported per case
+
+import sys
+import io
+import json
+import time
+import copy
+import resource
+import tempfile
+import argparse
+import subprocess
+from pathlib import Path
+from datetime import datetime
+from datetime import timedelta
+
+from multiprocessing import Process
+from multiprocessing import Queue
+from multiprocessing import Value
+
+import numpy
+from astropy.io import fits
+
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))
+from indi_timelapse.image import ImageProcessWorker  # noqa: E402
+
+
+SENSOR_SIZES = {
+    '2MP'  : (1920, 1080),
+    '6MP'  : (3096, 2080),
+    '20MP' : (5496, 3672),
+}
+
+BAYER_PATTERN = 'COLOR_BayerGR2RGB'
+
+STAGES = ('decode', 'calibrate', 'debayer', 'calculate_histogram', 'scale_8bit', 'image_text', 'write_img')
+
+
+def generate_fits(width, height, bits):
+    if bits == 8:
+        data = numpy.random.randint(5, 80, size=(height, width), dtype=numpy.uint8)
+    else:
+        data = numpy.random.randint(1280, 20480, size=(height, width), dtype=numpy.uint16)
+
+    f_blob = io.BytesIO()
+    fits.PrimaryHDU(data).writeto(f_blob)
+
+    return f_blob.getvalue()
+
+
+def generate_dark(dark_file, width, height, bits):
+    if bits == 8:
+        data = numpy.full((height, width), 2, dtype=numpy.uint8)
+    else:
+        data = numpy.full((height, width), 512, dtype=numpy.uint16)
+
+    fits.PrimaryHDU(data).writeto(str(dark_file))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def run_case(config, case, iterations, result_q):
+    width, height = SENSOR_SIZES[case['size']]
+
+    config = copy.deepcopy(config)
+    config['IMAGE_DEBAYER'] = BAYER_PATTERN if case['bayer'] else False
+    config['FILETRANSFER']['UPLOAD_IMAGE'] = False
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    base_dir = Path(tmp_dir.name)
+    base_dir.joinpath('images').mkdir()
+    base_dir.joinpath('darks').mkdir()
+
+    worker = ImageProcessWorker(
+        0,
+        config,
+        Queue(),
+        Queue(),
+        Value('f', 1.0),   # exposure
+        Value('i', 100),   # gain
+        Value('i', 1),     # bin
+        Value('f', 20.0),  # sensor temp
+        Value('i', 1),     # night
+    )
+    worker.base_dir = base_dir
+    worker.dark_library.dark_folder = base_dir.joinpath('darks')
+
+    generate_dark(worker.dark_library.getDarkFile(1, 100, 1), width, height, case['bits'])
+
+    blob = generate_fits(width, height, case['bits'])
+
+    timings = dict([(stage, list()) for stage in STAGES])
+    timings['total'] = list()
+
+    exp_date = datetime.now()
+
+    for i in range(iterations):
+        imgdata = bytearray(blob)  # writable like a frame buffer slot
+        exp_date += timedelta(seconds=1)
+
+        # keep the same dark for every frame
+        worker.exposure_v.value = 1.0
+        worker.last_exposure = 1.0
+
+        frame_start = time.perf_counter()
+
+        stage_start = time.perf_counter()
+        scidata = worker.decode(imgdata)
+        timings['decode'].append(time.perf_counter() - stage_start)
+
+        worker.image_height, worker.image_width = scidata.shape[:2]
+        worker.buffer_pool.reset(scidata.shape, scidata.dtype)
+
+        stage_start = time.perf_counter()
+        scidata_calibrated = worker.calibrate(scidata)
+        timings['calibrate'].append(time.perf_counter() - stage_start)
+
+        stage_start = time.perf_counter()
+        scidata = worker.debayer(scidata_calibrated)
+        timings['debayer'].append(time.perf_counter() - stage_start)
+
+        stage_start = time.perf_counter()
+        worker.calculate_histogram(scidata, data_bayer=scidata_calibrated)
+        timings['calculate_histogram'].append(time.perf_counter() - stage_start)
+
+        if i == 0:
+            # compare the ADU modes with the full resolution result
+            adu_full, percentiles_full = worker.measure_adu(scidata, data_bayer=scidata_calibrated, mode='full')
+
+            adu_accuracy = dict()
+            for mode in ('subsample', 'bayer'):
+                adu, percentiles = worker.measure_adu(scidata, data_bayer=scidata_calibrated, mode=mode)
+                adu_accuracy[mode] = {
+                    'adu'             : adu,
+                    'adu_full'        : adu_full,
+                    'error_pct'       : abs(adu - adu_full) / adu_full * 100,
+                    'percentile_diff' : dict([(k, percentiles[k] - percentiles_full[k]) for k in percentiles_full.keys()]),
+                }
+
+        stage_start = time.perf_counter()
+        if not worker.write_16bit():
+            scidata = worker.scale_8bit(scidata)
+        timings['scale_8bit'].append(time.perf_counter() - stage_start)
+
+        stage_start = time.perf_counter()
+        worker.image_text(scidata, exp_date)
+        timings['image_text'].append(time.perf_counter() - stage_start)
+
+        stage_start = time.perf_counter()
+        worker.write_img(scidata, exp_date)
+        timings['write_img'].append(time.perf_counter() - stage_start)
+
+        timings['total'].append(time.perf_counter() - frame_start)
+
+
+    total_s = sum(timings['total'])
+
+    result = dict(case)
+    result['width'] = width
+    result['height'] = height
+    result['iterations'] = iterations
+    result['adu_mode'] = config.get('ADU_MODE', 'full')
+    result['adu_accuracy'] = adu_accuracy
+    result['stages'] = dict()
+
+    for stage, values in timings.items():
+        result['stages'][stage] = {
+            'p50_ms' : percentile(values, 50) * 1000,
+            'p95_ms' : percentile(values, 95) * 1000,
+            'p99_ms' : percentile(values, 99) * 1000,
+            'max_ms' : max(values) * 1000,
+        }
+
+    result['frames_per_s'] = iterations / total_s
+    result['megapixels_per_s'] = (width * height * iterations) / total_s / 1000000
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+
+    tmp_dir.cleanup()
+
+    result_q.put(result)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--config',
+        '-c',
+        help='config file',
+        type=argparse.FileType('r'),
+        required=True,
+    )
+    argparser.add_argument(
+        '--iterations',
+        '-i',
+        help='frames per case',
+        type=int,
+        default=20,
+    )
+    argparser.add_argument(
+        '--size',
+        '-s',
+        help='sensor sizes',
+        choices=tuple(SENSOR_SIZES.keys()),
+        action='append',
+    )
+    argparser.add_argument(
+        '--period',
+        '-p',
+        help='target exposure period (default EXPOSURE_PERIOD)',
+        type=float,
+    )
+    argparser.add_argument(
+        '--output',
+        '-o',
+        help='json output file',
+        type=argparse.FileType('w'),
+        default=sys.stdout,
+    )
+
+    args = argparser.parse_args()
+
+
+    config = json.loads(args.config.read())
+    args.config.close()
+
+    if args.period:
+        period = args.period
+    else:
+        period = float(config['EXPOSURE_PERIOD'])
+
+
+    sizes = args.size
+    if not sizes:
+        sizes = list(SENSOR_SIZES.keys())
+
+
+    results = list()
+
+    for size in sizes:
+        for bits in (8, 16):
+            for bayer in (False, True):
+                case = {
+                    'size'  : size,
+                    'bits'  : bits,
+                    'bayer' : bayer,
+                }
+
+                print('Running {0:s} {1:d} bit {2:s}'.format(size, bits, 'bayer' if bayer else 'mono'), file=sys.stderr)
+
+                result_q = Queue()
+                p = Process(target=run_case, args=(config, case, args.iterations, result_q))
+                p.start()
+                p.join()
+
+                if p.exitcode != 0:
+                    print('Case failed: {0:s}'.format(json.dumps(case)), file=sys.stderr)
+                    continue
+
+                result = result_q.get()
+
+                # worst case frame must fit into the exposure period
+                result['sustainable'] = (result['stages']['total']['p99_ms'] / 1000) < period
+
+                results.append(result)
+
+
+    try:
+        git_commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=str(Path(__file__).parent),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        ).stdout.decode().strip()
+    except FileNotFoundError:
+        git_commit = None
+
+
+    report = {
+        'time'            : datetime.now().strftime('%s'),
+        'commit'          : git_commit,
+        'exposure_period' : period,
+        'results'         : results,
+    }
+
+    json.dump(report, args.output, indent=4)
+    args.output.write('\n')
@@ -23,7 +23,7 @@ if __name__ == "__main__":
     argparser.add_argument(
         'action',
         help='action',
-        choices=('run', 'darks', 'generateDayTimelapse', 'generateNightTimelapse', 'generateAllTimelapse', 'expireImages'),
+        choices=('run', 'darks', 'generateDayTimelapse', 'generateNightTimelapse', 'generateAllTimelapse', 'expireImages', 'catalogRebuild', 'catalogCheck'),
     )
     argparser.add_argument(
         '--config',